@@ -0,0 +1,322 @@
+import contextlib
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import click
+
+# Benchmarks the checkout this file belongs to, not an installed mpbridge
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mpbridge.checksum import CHECKSUMS  # noqa: E402
+from mpbridge.profiler import Profiler  # noqa: E402
+from mpbridge.serial_transport import ExtendedSerialTransport  # noqa: E402
+from mpbridge.transfer import TRANSFER_PROFILES, TransferProfile  # noqa: E402
+from mpbridge.tree import LocalTree  # noqa: E402
+from simboard import SimulatedBoard  # noqa: E402
+
+SEED = 1
+SMALL_FILES = 1000
+BRIDGE_FILES = 200
+ASSET_SIZE = 256 * 1024
+
+
+class Workspace:
+    # A local project and the filesystem of the simulated board, both in a
+    # fresh temporary directory per run
+    def __init__(self, base: str):
+        self.local = os.path.join(base, "local")
+        self.board = os.path.join(base, "board")
+        self.cache = os.path.join(base, "cache")
+        for path in (self.local, self.board, self.cache):
+            os.makedirs(path)
+        self.random = random.Random(SEED)
+
+    def write(self, rel: str, data: bytes):
+        path = os.path.join(self.local, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data)
+
+    def source(self, size: int) -> bytes:
+        lines = [
+            f"value_{self.random.randrange(100)} = {self.random.random()!r}\n"
+            for _ in range(size // 24 + 1)
+        ]
+        return "".join(lines).encode()[:size]
+
+    def add_project(self, files: int):
+        for i in range(files):
+            self.write(
+                f"lib/pkg{i % 20}/sub{i % 3}/module{i}.py",
+                self.source(self.random.randrange(200, 2000)),
+            )
+
+    def deploy(self):
+        # Puts the board in sync without going over the link
+        shutil.rmtree(self.board)
+        shutil.copytree(self.local, self.board)
+
+    def local_files(self) -> list[str]:
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.local)
+            for root, _, names in os.walk(self.local)
+            for name in names
+        )
+
+    def move(self, src: str, dest: str):
+        os.rename(os.path.join(self.local, src), os.path.join(self.local, dest))
+
+
+def setup_first_deploy(ws: Workspace):
+    ws.add_project(SMALL_FILES)
+
+
+def setup_one_file_edit(ws: Workspace):
+    ws.add_project(SMALL_FILES)
+    ws.deploy()
+    ws.write("lib/pkg7/sub1/module607.py", ws.source(1200))
+
+
+def setup_rename_refactor(ws: Workspace):
+    ws.add_project(SMALL_FILES)
+    ws.deploy()
+    for i in range(0, 20, 2):
+        ws.move(f"lib/pkg{i}", f"lib/renamed{i}")
+    for rel in ws.local_files()[::25]:
+        ws.move(rel, rel[:-3] + "_v2.py")
+
+
+def setup_large_asset(ws: Workspace):
+    ws.write("assets/firmware.bin", ws.random.randbytes(ASSET_SIZE))
+    ws.deploy()
+    with open(os.path.join(ws.local, "assets/firmware.bin"), "r+b") as file:
+        file.seek(ASSET_SIZE // 3)
+        file.write(ws.random.randbytes(512))
+
+
+def setup_clean_sync(ws: Workspace):
+    ws.add_project(SMALL_FILES)
+    ws.deploy()
+    for rel in ws.local_files()[::5]:
+        os.remove(os.path.join(ws.local, rel))
+    for i in range(50):
+        ws.write(f"lib/new/module{i}.py", ws.source(800))
+
+
+def setup_bridge(ws: Workspace):
+    ws.add_project(BRIDGE_FILES)
+    ws.deploy()
+    shutil.rmtree(ws.local)
+    os.makedirs(ws.local)
+
+
+def setup_deployed(ws: Workspace):
+    ws.add_project(BRIDGE_FILES)
+    ws.deploy()
+
+
+def run_sync(st: ExtendedSerialTransport, ws: Workspace, use_hashtable: bool):
+    st.sync_with_dir(dir_path=ws.local, push=True, use_hashtable=use_hashtable)
+
+
+def run_clean_sync(st: ExtendedSerialTransport, ws: Workspace, use_hashtable: bool):
+    tree = LocalTree(ws.local)
+    st.delete_absent_items(dir_path=ws.local, tree=tree)
+    st.sync_with_dir(
+        dir_path=ws.local, push=True, use_hashtable=use_hashtable, tree=tree
+    )
+
+
+def run_bridge(st: ExtendedSerialTransport, ws: Workspace, use_hashtable: bool):
+    st.mirror_to_dir(dir_path=ws.local)
+
+
+def run_clear(st: ExtendedSerialTransport, ws: Workspace, use_hashtable: bool):
+    st.clear_all()
+
+
+SCENARIOS = {
+    "first-deploy": (setup_first_deploy, run_sync),
+    "one-file-edit": (setup_one_file_edit, run_sync),
+    "rename-refactor": (setup_rename_refactor, run_clean_sync),
+    "large-asset": (setup_large_asset, run_sync),
+    "clean-sync": (setup_clean_sync, run_clean_sync),
+    "bridge": (setup_bridge, run_bridge),
+    "bridge-resume": (setup_deployed, run_bridge),
+    "clear": (setup_deployed, run_clear),
+}
+
+
+def run_scenario(
+    name: str, board_options: dict, transport_options: dict, use_hashtable: bool
+) -> dict:
+    setup, operation = SCENARIOS[name]
+    with tempfile.TemporaryDirectory(prefix="mpbridge-bench-") as base:
+        ws = Workspace(base)
+        setup(ws)
+        # Local hashes are never cached from an earlier run
+        os.environ["XDG_CACHE_HOME"] = ws.cache
+        board = SimulatedBoard(ws.board, **board_options)
+        # Counts the requests sent to the agent, which the board cannot tell
+        # apart from other traffic
+        profiler = Profiler()
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            st = ExtendedSerialTransport(
+                device=board.device, profiler=profiler, **transport_options
+            )
+            st.enter_raw_repl_verbose()
+            operation(st, ws, use_hashtable)
+            st.exit_raw_repl_verbose()
+            st.close()
+        seconds = time.perf_counter() - start
+        board.close()
+    return {
+        "seconds": seconds,
+        "round_trips": board.stats["execs"] + profiler.agent_requests,
+        "execs": board.stats["execs"],
+        "agent_requests": profiler.agent_requests,
+        "bytes_to_board": board.stats["rx"],
+        "bytes_from_board": board.stats["tx"],
+    }
+
+
+@click.command()
+@click.option(
+    "--scenario",
+    "-s",
+    "scenarios",
+    type=click.Choice(list(SCENARIOS)),
+    multiple=True,
+    help="Scenario to run, can be repeated. Runs all of them by default",
+)
+@click.option(
+    "--repeat",
+    "-r",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Runs per scenario, the median time is reported",
+)
+@click.option(
+    "--baudrate",
+    type=click.IntRange(min=0),
+    default=115200,
+    show_default=True,
+    help="Speed of the simulated link, 0 for unthrottled",
+)
+@click.option(
+    "--exec-latency",
+    type=click.FloatRange(min=0),
+    default=0.005,
+    show_default=True,
+    help="Seconds the board takes before running each exec",
+)
+@click.option(
+    "--mem-free",
+    type=click.IntRange(min=1024),
+    default=100_000,
+    show_default=True,
+    help="Free RAM of the board in bytes, larger allocations fail",
+)
+@click.option(
+    "--no-deflate",
+    is_flag=True,
+    default=False,
+    help="Simulate a board without the deflate module",
+)
+@click.option("--agent", "use_agent", is_flag=True, default=False)
+@click.option("--compress", is_flag=True, default=False)
+@click.option("--delta", is_flag=True, default=False)
+@click.option("--bundle", is_flag=True, default=False)
+@click.option("--use-hashtable", is_flag=True, default=False)
+@click.option(
+    "--checksum",
+    type=click.Choice(["auto", *CHECKSUMS]),
+    default="auto",
+    show_default=True,
+)
+@click.option(
+    "--transfer-profile",
+    default="auto",
+    show_default=True,
+    help=f"auto, {', '.join(TRANSFER_PROFILES)} or CHUNK_SIZE[:WINDOW]",
+)
+@click.option(
+    "--output",
+    "-o",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the results to a JSON file instead of stdout",
+)
+def main(
+    scenarios,
+    repeat,
+    baudrate,
+    exec_latency,
+    mem_free,
+    no_deflate,
+    use_agent,
+    compress,
+    delta,
+    bundle,
+    use_hashtable,
+    checksum,
+    transfer_profile,
+    output,
+):
+    """Run mpbridge scenarios against a simulated board"""
+    board_options = {
+        "baudrate": baudrate,
+        "exec_latency": exec_latency,
+        "mem_free": mem_free,
+        "deflate": not no_deflate,
+    }
+    transport_options = {
+        "use_agent": use_agent,
+        "compress": compress,
+        "delta": delta,
+        "bundle": bundle,
+        "checksum": checksum,
+        "transfer_profile": TransferProfile.parse(transfer_profile),
+    }
+    results = {}
+    for name in scenarios or SCENARIOS:
+        runs = [
+            run_scenario(name, board_options, transport_options, use_hashtable)
+            for _ in range(repeat)
+        ]
+        # Counters are the same for every run, only the time varies
+        result = dict(runs[0], seconds=statistics.median(r["seconds"] for r in runs))
+        results[name] = result
+        click.echo(
+            f"{name:16} {result['seconds']:7.2f}s {result['round_trips']:6} round "
+            f"trips {result['bytes_to_board']:9} B up {result['bytes_from_board']:9} "
+            "B down",
+            err=True,
+        )
+    report = {
+        "board": board_options,
+        "options": dict(
+            transport_options,
+            transfer_profile=transfer_profile,
+            use_hashtable=use_hashtable,
+        ),
+        "repeat": repeat,
+        "scenarios": results,
+    }
+    if output is None:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
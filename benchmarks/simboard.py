@@ -0,0 +1,342 @@
+import binascii
+import builtins
+import errno
+import hashlib
+import io
+import os
+import pty
+import struct
+import sys
+import threading
+import time
+import tty
+import zlib
+
+# A stand-in MicroPython board for benchmarks. It serves the raw REPL (and raw
+# paste mode) on a pty and runs the received code with CPython, against a real
+# directory and small fakes of the MicroPython modules mpbridge relies on.
+# The link can be throttled to a baud rate, each exec can be delayed and
+# allocations larger than the free RAM of the board fail with MemoryError
+RAW_PASTE_WINDOW = 128
+UNIQUE_ID = b"\x4d\x50\x42\x00\x00\x01"
+
+
+class SimulatedBoard:
+    def __init__(
+        self,
+        root: str,
+        baudrate: int = 0,
+        exec_latency: float = 0.0,
+        mem_free: int = 100_000,
+        deflate: bool = True,
+    ):
+        self.root = root
+        self.baudrate = baudrate
+        self.exec_latency = exec_latency
+        self.mem_free = mem_free
+        self.deflate = deflate
+        self.stats = {"execs": 0, "rx": 0, "tx": 0}
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.device = os.ttyname(self._slave)
+        self._buffer = b""
+        # When the simulated line is busy until, throttled writes and reads
+        # queue up behind each other like on a real UART
+        self._line_free_at = 0.0
+        self._globals = self._new_globals()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        os.close(self._master)
+        os.close(self._slave)
+
+    def reset_stats(self):
+        self.stats = {"execs": 0, "rx": 0, "tx": 0}
+
+    def _throttle(self, size: int):
+        if not self.baudrate:
+            return
+        now = time.monotonic()
+        self._line_free_at = max(now, self._line_free_at) + size * 10 / self.baudrate
+        # Sleeping per byte would mostly measure the scheduler
+        if self._line_free_at - now > 0.001:
+            time.sleep(self._line_free_at - now)
+
+    def _read(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            self._buffer += os.read(self._master, 65536)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.stats["rx"] += size
+        self._throttle(size)
+        return data
+
+    def _write(self, data):
+        data = bytes(data)
+        self.stats["tx"] += len(data)
+        self._throttle(len(data))
+        while data:
+            data = data[os.write(self._master, data) :]
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def _alloc(self, size: int):
+        if size > self.mem_free:
+            raise MemoryError(f"memory allocation failed, allocating {size} bytes")
+
+    def _new_globals(self) -> dict:
+        board = self
+
+        class OS:
+            sep = "/"
+
+            def ilistdir(self, path="/"):
+                entries = sorted(os.scandir(board._path(path)), key=lambda e: e.name)
+                for entry in entries:
+                    if entry.is_dir():
+                        yield entry.name, 0x4000, 0, 0
+                    else:
+                        yield entry.name, 0x8000, 0, entry.stat().st_size
+
+            def listdir(self, path="/"):
+                return sorted(os.listdir(board._path(path)))
+
+            def stat(self, path):
+                st = os.stat(board._path(path))
+                mode = 0x4000 if os.path.isdir(board._path(path)) else 0x8000
+                mtime = int(st.st_mtime)
+                return mode, 0, 0, 0, 0, 0, st.st_size, mtime, mtime, mtime
+
+            def remove(self, path):
+                os.remove(board._path(path))
+
+            def rmdir(self, path):
+                os.rmdir(board._path(path))
+
+            def mkdir(self, path):
+                os.mkdir(board._path(path))
+
+            def rename(self, src, dest):
+                os.rename(board._path(src), board._path(dest))
+
+            def statvfs(self, path):
+                return 4096, 4096, 1024, 512, 512, 0, 0, 0, 0, 255
+
+        class GC:
+            def collect(self):
+                pass
+
+            def mem_free(self):
+                return board.mem_free
+
+            def mem_alloc(self):
+                return 0
+
+        class Stdin:
+            def read(self, size):
+                return board._read(size)
+
+            def readinto(self, buf, size=None):
+                size = len(buf) if size is None else size
+                buf[:size] = board._read(size)
+                return size
+
+        class Stdout:
+            def write(self, data):
+                board._write(data)
+                return len(data)
+
+        class Sys:
+            implementation = sys.implementation
+            platform = "simulated"
+            stdin = type("stdin", (), {"buffer": Stdin()})
+            stdout = type("stdout", (), {"buffer": Stdout()})
+
+        class MicroPython:
+            def kbd_intr(self, c):
+                pass
+
+            def const(self, value):
+                return value
+
+        class Machine:
+            def reset(self):
+                board._globals = board._new_globals()
+
+            def unique_id(self):
+                return UNIQUE_ID
+
+        class Time:
+            def ticks_ms(self):
+                return int(time.monotonic() * 1000)
+
+            def ticks_diff(self, a, b):
+                return a - b
+
+            def sleep_ms(self, ms):
+                time.sleep(ms / 1000)
+
+            def time(self):
+                return int(time.time())
+
+        class DecompressIO:
+            def __init__(self, stream, wbits):
+                self.stream = stream
+                self.decompressor = zlib.decompressobj(wbits)
+                self.pending = b""
+
+            def read(self, size=-1):
+                while size < 0 or len(self.pending) < size:
+                    data = self.stream.read(256)
+                    if not data:
+                        break
+                    self.pending += self.decompressor.decompress(data)
+                size = len(self.pending) if size < 0 else size
+                data, self.pending = self.pending[:size], self.pending[size:]
+                return data
+
+            def readinto(self, buf):
+                data = self.read(len(buf))
+                buf[: len(data)] = data
+                return len(data)
+
+        class DeflateIO(DecompressIO):
+            def __init__(self, stream, fmt=0, wbits=0, close=False):
+                super().__init__(stream, 47)
+                wbits = wbits or 10
+                self.wbits = {-1: -wbits, 2: 16 + wbits}.get(fmt, wbits)
+                self.compressor = None
+
+            def write(self, data):
+                if self.compressor is None:
+                    self.compressor = zlib.compressobj(9, zlib.DEFLATED, self.wbits)
+                self.stream.write(self.compressor.compress(bytes(data)))
+                return len(data)
+
+            def close(self):
+                if self.compressor is not None:
+                    self.stream.write(self.compressor.flush())
+
+        class Deflate:
+            RAW, AUTO, ZLIB, GZIP = -1, 0, 1, 2
+
+        class Zlib:
+            @staticmethod
+            def DecompIO(stream, wbits=0):
+                return DecompressIO(stream, wbits or 15)
+
+        Deflate.DeflateIO = DeflateIO
+        modules = {
+            "os": OS(),
+            "gc": GC(),
+            "sys": Sys,
+            "micropython": MicroPython(),
+            "machine": Machine(),
+            "time": Time(),
+            "hashlib": hashlib,
+            "binascii": binascii,
+            "struct": struct,
+            "io": io,
+            "errno": errno,
+            "zlib": Zlib,
+        }
+        if self.deflate:
+            modules["deflate"] = Deflate
+
+        def import_(name, globals=None, locals=None, fromlist=(), level=0):
+            # MicroPython also accepts the "u" prefixed module names
+            key = name[1:] if name.startswith("u") and name[1:] in modules else name
+            if key in modules:
+                return modules[key]
+            if name in ("array", "collections"):
+                return builtins.__import__(name, globals, locals, fromlist, level)
+            raise ImportError(f"no module named '{name}'")
+
+        def print_(*args, sep=" ", end="\n"):
+            text = sep.join(map(str, args)) + end
+            board._write(text.replace("\n", "\r\n").encode())
+
+        def open_(path, mode="r", *args, **kwargs):
+            return open(board._path(path), mode)
+
+        def bytearray_(*args):
+            if args and isinstance(args[0], int):
+                board._alloc(args[0])
+            return bytearray(*args)
+
+        device_builtins = dict(vars(builtins))
+        device_builtins.update(
+            __import__=import_, print=print_, open=open_, bytearray=bytearray_
+        )
+        return {"__builtins__": device_builtins, "__name__": "__main__"}
+
+    def _exec(self, source: bytes):
+        self.stats["execs"] += 1
+        if self.exec_latency:
+            time.sleep(self.exec_latency)
+        error = b""
+        try:
+            # The compiler needs the source in RAM, roughly
+            self._alloc(len(source))
+            exec(compile(source.decode(), "<stdin>", "exec"), self._globals)
+        except BaseException as e:
+            error = "Traceback (most recent call last):\r\n"
+            error = f"{error}{type(e).__name__}: {e}\r\n".encode()
+        self._write(b"\x04" + error + b"\x04>")
+
+    def _serve(self):
+        try:
+            self._serve_forever()
+        except OSError:
+            # Closed
+            pass
+
+    def _serve_forever(self):
+        raw = False
+        source = b""
+        while True:
+            c = self._read(1)
+            if not raw:
+                if c == b"\x01":
+                    raw = True
+                    source = b""
+                    self._write(b"raw REPL; CTRL-B to exit\r\n>")
+                continue
+            if c == b"\x02":
+                raw = False
+                self._write(b"\r\nMicroPython simulated board\r\n>>> ")
+            elif c == b"\x01":
+                source = b""
+                self._write(b"raw REPL; CTRL-B to exit\r\n>")
+            elif c == b"\x03":
+                source = b""
+            elif c == b"\x05":
+                if self._read(2) == b"A\x01":
+                    self._write(b"R\x01" + struct.pack("<H", RAW_PASTE_WINDOW))
+                    self._exec(self._read_raw_paste())
+            elif c == b"\x04":
+                if source:
+                    self._write(b"OK")
+                    source, pending = b"", source
+                    self._exec(pending)
+                else:
+                    self._globals = self._new_globals()
+                    self._write(
+                        b"OK\r\nMPY: soft reboot\r\nraw REPL; CTRL-B to exit\r\n>"
+                    )
+            else:
+                source += c
+
+    def _read_raw_paste(self) -> bytes:
+        source = bytearray()
+        received = 0
+        while (c := self._read(1)) != b"\x04":
+            source += c
+            received += 1
+            if received == RAW_PASTE_WINDOW:
+                received = 0
+                self._write(b"\x01")
+        self._write(b"\x04")
+        return bytes(source)
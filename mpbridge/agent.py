@@ -0,0 +1,419 @@
+import struct
+from contextlib import suppress
+
+from mpremote.transport_serial import TransportError
+
+from . import utils
+from .transfer import TransferInterrupted, read_exact, send_windowed
+
+# Resident helper executed once per session. Once `_mpb_serve()` is running,
+# the host talks to it with binary frames over the raw REPL stdin/stdout:
+#   request:  <op:u8> <arg_len:u16> <arg>
+#   response: <status:u8> <payload_len:u32> <payload>
+# Every request is answered with zero or more ITEM frames followed by a single
+# END frame, or an ERROR frame carrying the device-side exception
+AGENT_SRC = r"""
+import os, sys, gc
+from struct import pack, unpack
+from time import time
+try:
+    from micropython import kbd_intr
+except ImportError:
+    kbd_intr = lambda c: None
+_i = getattr(sys.stdin, "buffer", sys.stdin)
+_o = getattr(sys.stdout, "buffer", sys.stdout)
+_b = bytearray(1024)
+_m = memoryview(_b)
+def _tx(s, d=b""):
+    _o.write(pack("<BI", s, len(d)))
+    _o.write(d)
+def _ls(a):
+    st = [a.decode()]
+    while st:
+        d = st.pop()
+        for e in os.ilistdir(d):
+            p = d.rstrip("/") + "/" + e[0]
+            s = os.stat(p)
+            if e[1] == 0x4000:
+                st.append(p)
+                _tx(0, pack("<BII", 0, 0, s[8]) + p.encode())
+            else:
+                _tx(0, pack("<BII", 1, s[6], s[8]) + p.encode())
+        gc.collect()
+    _tx(2)
+def _hash(a):
+    for p in a.decode().split("\n"):
+        try:
+            _tx(0, _mpb_digest(p))
+        except OSError:
+            _tx(0)
+    _tx(2)
+def _mtimes(a):
+    _tx(0, pack("<I", int(time())))
+    for p in a.decode().split("\n"):
+        try:
+            _tx(0, pack("<I", os.stat(p)[8]))
+        except OSError:
+            _tx(0)
+    _tx(2)
+def _get(a):
+    p = a.decode()
+    with open(p, "rb") as f:
+        _tx(0, pack("<I", os.stat(p)[6]))
+        while n := f.readinto(_b):
+            _tx(0, _m[:n])
+    _tx(2)
+def _put(a):
+    n, c = unpack("<II", a[:8])
+    m = memoryview(bytearray(c))
+    e = None
+    p = a[8:].decode()
+    t = p + ".mpbt"
+    with open(t, "wb") as f:
+        _tx(0)
+        while n:
+            k = min(n, c)
+            _i.readinto(m[:1])
+            if m[0] != 6:
+                e = e or OSError("transfer aborted")
+                break
+            _i.readinto(m[:k])
+            if e is None:
+                try:
+                    f.write(m[:k])
+                except OSError as x:
+                    e = x
+            n -= k
+            _o.write(b"\x06")
+    if e:
+        os.remove(t)
+        raise e
+    os.rename(t, p)
+    _tx(2)
+def _mv(a):
+    s, d = a.decode().split("\0")
+    os.rename(s, d)
+    _tx(2)
+def _rm(a):
+    os.remove(a.decode())
+    _tx(2)
+def _rmdir(a):
+    os.rmdir(a.decode())
+    _tx(2)
+def _mkdir(a):
+    os.mkdir(a.decode())
+    _tx(2)
+def _inflate(a):
+    s, d = a.decode().split("\0")
+    _mpb_inflate(s, d)
+    _tx(2)
+def _deflate(a):
+    s, d = a[4:].decode().split("\0")
+    if _mpb_deflate(s, d, unpack("<I", a[:4])[0]):
+        _tx(0)
+    _tx(2)
+def _blocks(a):
+    _mpb_blocks(a[4:].decode(), unpack("<I", a[:4])[0], lambda d: _tx(0, d))
+    _tx(2)
+def _patch(a):
+    p, d, h = a[4:].decode().split("\0")
+    _mpb_patch(p, d, unpack("<I", a[:4])[0], h)
+    _tx(2)
+def _batch(a):
+    x = a.decode().split("\0")
+    x = [x[i:i + 3] for i in range(0, len(x), 3)]
+    _mpb_batch(x, lambda s: _tx(0, s.encode()))
+    _tx(2)
+def _clear(a):
+    _mpb_clear(a.decode(), lambda s: _tx(0, s.encode()))
+    _tx(2)
+def _append(a):
+    n = unpack("<H", a[:2])[0]
+    with open(a[2:2 + n].decode(), "ab") as f:
+        f.write(a[2 + n:])
+    _tx(2)
+def _unbundle(a):
+    n, c, z = unpack("<IIB", a)
+    for p in _mpb_unbundle(n, c, z, lambda: _tx(0)):
+        _tx(0, p.encode())
+    _tx(2)
+_ops = {
+    1: _ls, 3: _hash, 4: _get, 5: _put, 6: _mv, 7: _rm, 8: _rmdir,
+    9: _mkdir, 10: _inflate, 11: _deflate, 12: _blocks, 13: _patch, 14: _batch,
+    15: _clear, 16: _append, 17: _unbundle, 18: _mtimes,
+}
+def _mpb_serve():
+    kbd_intr(-1)
+    _tx(2)
+    while 1:
+        n = 0
+        try:
+            o, n = unpack("<BH", _i.read(3))
+            a = _i.read(n) if n else b""
+            n = 0
+            if not o:
+                break
+            _ops[o](a)
+        except Exception as e:
+            a = None
+            while n:
+                n -= _i.readinto(_m[:min(n, 1024)])
+            _tx(1, repr(e).encode())
+        gc.collect()
+    kbd_intr(3)
+    _tx(2)
+"""
+
+OP_QUIT = 0
+OP_LIST = 1
+# Uses the session checksum defined by DIGEST_FUNCS
+OP_HASH = 3
+OP_GET = 4
+OP_PUT = 5
+OP_RENAME = 6
+OP_RM = 7
+OP_RMDIR = 8
+OP_MKDIR = 9
+# Only usable after COMPRESSION_FUNCS has been executed on the board
+OP_INFLATE = 10
+OP_DEFLATE = 11
+# Only usable after DELTA_FUNCS has been executed on the board
+OP_BLOCKS = 12
+OP_PATCH = 13
+# Only usable after MUTATION_FUNCS has been executed on the board
+OP_BATCH = 14
+OP_CLEAR = 15
+OP_APPEND = 16
+# Only usable after BUNDLE_FUNCS has been executed on the board
+OP_UNBUNDLE = 17
+OP_MTIMES = 18
+
+STATUS_ITEM = 0
+STATUS_ERROR = 1
+STATUS_END = 2
+
+REQUEST_HEADER = "<BH"
+RESPONSE_HEADER = "<BI"
+MAX_ARG_SIZE = 0xFFFF
+# Data per append request, kept small as the board holds the whole request
+# in memory
+MAX_APPEND_SIZE = 4096
+# Upper bound for the encoded size of path lists sent in a single request, for
+# the same reason
+MAX_BATCH_SIZE = 4096
+
+
+def _encoded_size(item: str) -> int:
+    # Including the separator between items
+    return len(item.encode("utf-8")) + 1
+
+
+class DeviceAgent:
+    def __init__(self, transport):
+        self.transport = transport
+        self.active = False
+
+    def start(self):
+        self.transport.exec(AGENT_SRC)
+        self.transport.exec_raw_no_follow("_mpb_serve()")
+        self._expect_end()
+        self.active = True
+
+    def stop(self):
+        if not self.active:
+            return
+        self._request(OP_QUIT)
+        self._expect_end()
+        self.transport.follow(timeout=10)
+        self.active = False
+
+    def listdir(self, root: str = "/"):
+        dirs = {}
+        files = {}
+        mtimes = {}
+        self._request(OP_LIST, root.encode("utf-8"))
+        for payload in self._items():
+            is_file, size, mtime = struct.unpack("<BII", payload[:9])
+            path = payload[9:].decode("utf-8")
+            if is_file:
+                files[path] = size
+            else:
+                dirs[path] = 0
+            mtimes[path] = mtime
+        return dirs, files, mtimes
+
+    def digests(self, paths) -> dict[str, bytes]:
+        digests = {}
+        for batch in utils.batched_by_size(paths, MAX_BATCH_SIZE, _encoded_size):
+            self._request(OP_HASH, "\n".join(batch).encode("utf-8"))
+            for path, digest in zip(batch, list(self._items())):
+                if digest:
+                    digests[path] = digest
+        return digests
+
+    def mtimes(self, paths) -> tuple[int, dict[str, int]]:
+        clock = None
+        mtimes = {}
+        for batch in utils.batched_by_size(paths, MAX_BATCH_SIZE, _encoded_size):
+            self._request(OP_MTIMES, "\n".join(batch).encode("utf-8"))
+            items = self._items()
+            now = struct.unpack("<I", next(items))[0]
+            clock = now if clock is None else clock
+            for path, mtime in zip(batch, list(items)):
+                if mtime:
+                    mtimes[path] = struct.unpack("<I", mtime)[0]
+        return clock or 0, mtimes
+
+    def get(self, src: str, dest_file, progress_callback=None):
+        self._request(OP_GET, src.encode("utf-8"))
+        items = self._items()
+        total = struct.unpack("<I", next(items))[0]
+        written = 0
+        for chunk in items:
+            dest_file.write(chunk)
+            written += len(chunk)
+            if progress_callback:
+                progress_callback(written, total)
+
+    def put(
+        self,
+        src_file,
+        size: int,
+        dest: str,
+        chunk_size=1024,
+        window=1,
+        progress_callback=None,
+    ):
+        self._request(
+            OP_PUT, struct.pack("<II", size, chunk_size) + dest.encode("utf-8")
+        )
+        self._expect_item()
+        self._send(src_file, size, chunk_size, window, progress_callback)
+        self._expect_end()
+
+    def rename(self, src: str, dest: str):
+        self._request(OP_RENAME, f"{src}\0{dest}".encode("utf-8"))
+        self._expect_end()
+
+    def rm(self, path: str):
+        self._request(OP_RM, path.encode("utf-8"))
+        self._expect_end()
+
+    def rmdir(self, path: str):
+        self._request(OP_RMDIR, path.encode("utf-8"))
+        self._expect_end()
+
+    def mkdir(self, path: str):
+        self._request(OP_MKDIR, path.encode("utf-8"))
+        self._expect_end()
+
+    def inflate(self, src: str, dest: str):
+        self._request(OP_INFLATE, f"{src}\0{dest}".encode("utf-8"))
+        self._expect_end()
+
+    def deflate(self, src: str, dest: str, threshold: int) -> bool:
+        self._request(
+            OP_DEFLATE,
+            struct.pack("<I", threshold) + f"{src}\0{dest}".encode("utf-8"),
+        )
+        # An item is only sent when `dest` was written
+        return bool(list(self._items()))
+
+    def blocks(self, path: str, block_size: int) -> list[bytes]:
+        self._request(OP_BLOCKS, struct.pack("<I", block_size) + path.encode("utf-8"))
+        return list(self._items())
+
+    def patch(self, path: str, delta_path: str, block_size: int, expected_sha1: str):
+        self._request(
+            OP_PATCH,
+            struct.pack("<I", block_size)
+            + f"{path}\0{delta_path}\0{expected_sha1}".encode("utf-8"),
+        )
+        self._expect_end()
+
+    def batch(self, ops) -> list[str]:
+        errors = []
+        items = [f"{code}\0{path}\0{dest or ''}" for code, path, dest in ops]
+        for batch in utils.batched_by_size(items, MAX_BATCH_SIZE, _encoded_size):
+            self._request(OP_BATCH, "\0".join(batch).encode("utf-8"))
+            errors.extend(payload.decode("utf-8") for payload in self._items())
+        return errors
+
+    def clear(self, root: str, callback):
+        self._request(OP_CLEAR, root.encode("utf-8"))
+        for payload in self._items():
+            callback(payload.decode("utf-8"))
+
+    def append(self, path: str, data: bytes):
+        path = path.encode("utf-8")
+        header = struct.pack("<H", len(path)) + path
+        for i in range(0, len(data), MAX_APPEND_SIZE):
+            self._request(OP_APPEND, header + data[i : i + MAX_APPEND_SIZE])
+            self._expect_end()
+
+    def unbundle(
+        self,
+        src_file,
+        size: int,
+        compressed: bool,
+        chunk_size=1024,
+        window=1,
+        progress_callback=None,
+    ) -> list[str]:
+        self._request(OP_UNBUNDLE, struct.pack("<IIB", size, chunk_size, compressed))
+        self._expect_item()
+        self._send(src_file, size, chunk_size, window, progress_callback)
+        return [payload.decode("utf-8") for payload in self._items()]
+
+    def _send(self, src_file, size, chunk_size, window, progress_callback):
+        try:
+            send_windowed(
+                self.transport.serial,
+                src_file,
+                size,
+                chunk_size,
+                window,
+                progress_callback,
+            )
+        except TransferInterrupted as e:
+            # The request is answered with an error, or its results when the
+            # receiver had everything already
+            with suppress(TransportError):
+                for _ in self._items():
+                    pass
+            if isinstance(e.reason, KeyboardInterrupt):
+                # Leave the board at the raw REPL for the next session
+                self.stop()
+            raise e.reason from None
+
+    def _request(self, op: int, arg: bytes = b""):
+        if len(arg) > MAX_ARG_SIZE:
+            raise TransportError("agent: request argument too long")
+        if self.transport.profiler is not None:
+            self.transport.profiler.agent_requests += 1
+        self.transport.serial.write(struct.pack(REQUEST_HEADER, op, len(arg)) + arg)
+
+    def _recv(self) -> tuple[int, bytes]:
+        header = read_exact(self.transport.serial, struct.calcsize(RESPONSE_HEADER))
+        status, size = struct.unpack(RESPONSE_HEADER, header)
+        payload = read_exact(self.transport.serial, size) if size else b""
+        if status == STATUS_ERROR:
+            raise TransportError("exception", b"", payload)
+        return status, payload
+
+    def _items(self):
+        while True:
+            status, payload = self._recv()
+            if status == STATUS_END:
+                return
+            yield payload
+
+    def _expect_item(self):
+        status, _ = self._recv()
+        if status != STATUS_ITEM:
+            raise TransportError("agent: unexpected response")
+
+    def _expect_end(self):
+        status, _ = self._recv()
+        if status != STATUS_END:
+            raise TransportError("agent: unexpected response")
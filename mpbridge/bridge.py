@@ -1,10 +1,8 @@
 import os
 import pathlib
-import shutil
-import subprocess
-import tempfile
 import time
 from argparse import Namespace
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Optional
 
 import serial.tools.list_ports
@@ -13,38 +11,66 @@ from mpremote.main import State, argparse_repl
 from watchdog.observers import Observer
 
 from . import utils
+from .build import MpyCrossBuilder
+from .fanout import resolve_ports, sync_boards
 from .handler import EventHandler
-from .ignore import IgnoreStorage
-from .serial_transport import ExtendedSerialTransport
+from .profiler import Profiler
+from .serial_transport import COMPRESS_THRESHOLD, ExtendedSerialTransport
+from .transfer import TransferProfile
+from .tree import LocalTree
+from .uploader import UploadQueue
 
 
-def start_bridge_mode(port: str):
+def start_bridge_mode(
+    port: str,
+    use_agent: bool = False,
+    compress: bool = False,
+    compress_threshold: int = COMPRESS_THRESHOLD,
+    transfer_profile: Optional[TransferProfile] = None,
+    checksum: str = "auto",
+    profile: bool = False,
+    profile_json: Optional[str] = None,
+):
     port = utils.port_abbreviation(port)
     print(Fore.YELLOW, "- Starting bridge mode on", port)
     utils.reset_term_color()
-    st = ExtendedSerialTransport(device=port)
+    st = ExtendedSerialTransport(
+        device=port,
+        use_agent=use_agent,
+        compress=compress,
+        compress_threshold=compress_threshold,
+        transfer_profile=transfer_profile,
+        checksum=checksum,
+        profiler=Profiler() if profile or profile_json else None,
+    )
     st.enter_raw_repl_verbose()
 
-    with tempfile.TemporaryDirectory(
-        prefix=utils.get_temp_dirname_prefix(port)
-    ) as tmp_dir_path:
-        st.copy_all(dest_dir_path=tmp_dir_path)
-        print(Fore.YELLOW, "- Started bridge mode in", tmp_dir_path)
-        print(Fore.YELLOW, "- Use Ctrl-C to terminate the bridge")
-        utils.reset_term_color()
-        observer = Observer()
-        observer.schedule(
-            EventHandler(st=st, base_path=tmp_dir_path), tmp_dir_path, recursive=True
-        )
-        observer.start()
-        utils.open_dir(tmp_dir_path)
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            observer.stop()
-            st.exit_raw_repl_verbose()
-        observer.join()
+    mirror_dir_path = utils.get_mirror_dir(st.board_id or port)
+    os.makedirs(mirror_dir_path, exist_ok=True)
+    st.mirror_to_dir(dir_path=mirror_dir_path)
+    print(Fore.YELLOW, "- Started bridge mode in", mirror_dir_path)
+    print(Fore.YELLOW, "- Use Ctrl-C to terminate the bridge")
+    utils.reset_term_color()
+    queue = UploadQueue(st=st, base_path=mirror_dir_path)
+    queue.start()
+    observer = Observer()
+    observer.schedule(
+        EventHandler(queue=queue, base_path=mirror_dir_path),
+        mirror_dir_path,
+        recursive=True,
+    )
+    observer.start()
+    utils.open_dir(mirror_dir_path)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        observer.stop()
+    observer.join()
+    queue.stop()
+    st.exit_raw_repl_verbose()
+    if st.profiler is not None:
+        st.profiler.report(profile_json)
 
 
 def sync(
@@ -54,19 +80,69 @@ def sync(
     dry_run: bool,
     push_only: bool,
     use_hashtable: bool,
+    use_agent: bool = False,
+    compress: bool = False,
+    compress_threshold: int = COMPRESS_THRESHOLD,
+    delta: bool = False,
+    transfer_profile: Optional[TransferProfile] = None,
+    checksum: str = "auto",
+    bundle: bool = False,
+    profile: bool = False,
+    profile_json: Optional[str] = None,
 ):
-    port = utils.port_abbreviation(port)
+    ports = resolve_ports(port)
+    if not ports:
+        print(Fore.RED, f"E Couldn't find any connected devices matching {port}")
+        utils.reset_term_color()
+        return
+    if len(ports) > 1:
+        sync_boards(
+            ports=ports,
+            path=path,
+            clean=clean,
+            dry_run=dry_run,
+            use_hashtable=use_hashtable,
+            use_agent=use_agent,
+            compress=compress,
+            compress_threshold=compress_threshold,
+            delta=delta,
+            transfer_profile=transfer_profile,
+            checksum=checksum,
+            bundle=bundle,
+            profile=profile,
+            profile_json=profile_json,
+        )
+        return
+    port = ports[0]
     print(Fore.YELLOW, f"- Syncing files on {port} with {path}")
     utils.reset_term_color()
-    st = ExtendedSerialTransport(device=port)
+    st = ExtendedSerialTransport(
+        device=port,
+        use_agent=use_agent,
+        compress=compress,
+        compress_threshold=compress_threshold,
+        delta=delta,
+        transfer_profile=transfer_profile,
+        checksum=checksum,
+        bundle=bundle,
+        profiler=Profiler() if profile or profile_json else None,
+    )
     st.enter_raw_repl_verbose()
+    with st.phase("local scan"):
+        tree = LocalTree(path)
     if clean:
         print(Fore.YELLOW, f"Removing absent files from {port}")
-        st.delete_absent_items(dir_path=path, dry=dry_run)
+        st.delete_absent_items(dir_path=path, dry=dry_run, tree=tree)
     st.sync_with_dir(
-        dir_path=path, dry=dry_run, push=push_only, use_hashtable=use_hashtable
+        dir_path=path,
+        dry=dry_run,
+        push=push_only,
+        use_hashtable=use_hashtable,
+        tree=tree,
     )
     st.exit_raw_repl_verbose()
+    if st.profiler is not None:
+        st.profiler.report(profile_json)
 
 
 def start_dev_mode(
@@ -76,63 +152,67 @@ def start_dev_mode(
     no_prompt: bool,
     use_hashtable: bool,
     mpy_cross_path: Optional[str],
+    use_agent: bool = False,
+    compress: bool = False,
+    compress_threshold: int = COMPRESS_THRESHOLD,
+    delta: bool = False,
+    transfer_profile: Optional[TransferProfile] = None,
+    checksum: str = "auto",
+    bundle: bool = False,
+    profile: bool = False,
+    profile_json: Optional[str] = None,
 ):
     path = utils.replace_backslashes(path)
     port = utils.port_abbreviation(port)
     print(Fore.YELLOW, f"- Syncing files on {port} with {path}")
     utils.reset_term_color()
+    # One connection serves every iteration and the REPL in between. The board
+    # is listed again on every iteration, as code run from the REPL or on reset
+    # may have changed its files
+    st = ExtendedSerialTransport(
+        device=port,
+        use_agent=use_agent,
+        compress=compress,
+        compress_threshold=compress_threshold,
+        delta=delta,
+        transfer_profile=transfer_profile,
+        checksum=checksum,
+        bundle=bundle,
+        profiler=Profiler() if profile or profile_json else None,
+    )
 
-    while True:
-        if mpy_cross_path is None:
+    builder = None
+    if mpy_cross_path is not None:
+        builder = MpyCrossBuilder(mpy_cross_path=mpy_cross_path, dir_path=path)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            # Compiled while the board is being connected to
+            build = None if builder is None else executor.submit(builder.build)
             _dev_mode_iter(
-                port=port,
+                st=st,
                 path=path,
+                build=build,
                 auto_reset=auto_reset,
                 no_prompt=no_prompt,
                 use_hashtable=use_hashtable,
+                profile_json=profile_json,
             )
 
-        else:
-            with tempfile.TemporaryDirectory(
-                prefix=utils.get_temp_dirname_prefix(port)
-            ) as tmp_dir_path:
-                ignore = IgnoreStorage(dir_path=path)
-                ldirs, lfiles = utils.recursive_list_dir(path)
-
-                for ldir in ldirs.keys():
-                    os.mkdir(tmp_dir_path + ldir)
-                for lfile_rel, lfile_abs in lfiles.items():
-                    if not ignore.match_file(lfile_rel):
-                        if lfile_rel != "/main.py" and lfile_rel.endswith(".py"):
-                            subprocess.run(
-                                [
-                                    mpy_cross_path,
-                                    "-o",
-                                    tmp_dir_path + lfile_rel[:-3] + ".mpy",
-                                    lfile_abs,
-                                ],
-                                capture_output=False,
-                            )
-                        else:
-                            shutil.copyfile(src=lfile_abs, dst=tmp_dir_path + lfile_rel)
-                _dev_mode_iter(
-                    port=port,
-                    path=tmp_dir_path,
-                    auto_reset=auto_reset,
-                    no_prompt=no_prompt,
-                    use_hashtable=use_hashtable,
-                )
-
 
 def _dev_mode_iter(
-    port: str,
+    st: ExtendedSerialTransport,
     path: str,
     auto_reset: str,
     no_prompt: bool,
     use_hashtable: bool,
+    build: Optional[Future] = None,
+    profile_json: Optional[str] = None,
 ):
-    st = ExtendedSerialTransport(device=port)
     st.enter_raw_repl_verbose()
+    if build is not None:
+        with st.phase("mpy-cross build"):
+            path = build.result()
     if not no_prompt:
         print(Fore.YELLOW, "- Sync files")
         st.sync_with_dir(dir_path=path, use_hashtable=use_hashtable)
@@ -143,33 +223,51 @@ def _dev_mode_iter(
             end="",
         )
         utils.reset_term_color()
-        input()
+        with st.phase("prompt"):
+            input()
     print(Fore.YELLOW, "- Clean Sync files")
-    st.delete_absent_items(dir_path=path)
-    st.sync_with_dir(dir_path=path, use_hashtable=use_hashtable)
+    # Files may have changed while waiting at the prompt
+    with st.phase("local scan"):
+        tree = LocalTree(path)
+    st.delete_absent_items(dir_path=path, tree=tree)
+    st.sync_with_dir(dir_path=path, use_hashtable=use_hashtable, tree=tree)
+    if st.profiler is not None:
+        # One report per iteration, the REPL is not profiled
+        st.profiler.report(profile_json)
     if auto_reset is None:
         st.exit_raw_repl()
-        st.close()
     elif auto_reset == "hard":
         st.verbose_hard_reset()
-        st.close()
         time.sleep(1)
+        st.reopen()
     elif auto_reset == "soft":
         st.exit_raw_repl()
         st.verbose_soft_reset()
-        st.close()
-    start_repl(port)
+    start_repl(st.device_name, st=st)
+    if st.profiler is not None:
+        st.profiler.reset()
 
 
-def clear(port: str):
+def clear(
+    port: str,
+    use_agent: bool = False,
+    profile: bool = False,
+    profile_json: Optional[str] = None,
+):
     port = utils.port_abbreviation(port)
-    st = ExtendedSerialTransport(device=port)
+    st = ExtendedSerialTransport(
+        device=port,
+        use_agent=use_agent,
+        profiler=Profiler() if profile or profile_json else None,
+    )
     st.enter_raw_repl_verbose()
     st.clear_all()
     st.exit_raw_repl_verbose()
+    if st.profiler is not None:
+        st.profiler.report(profile_json)
 
 
-def start_repl(port: str):
+def start_repl(port: str, st: Optional[ExtendedSerialTransport] = None):
     from mpremote.commands import do_connect, do_disconnect
     from mpremote.repl import do_repl
 
@@ -177,9 +275,14 @@ def start_repl(port: str):
     utils.reset_term_color()
     port = utils.port_abbreviation(port)
     state = State()
-    do_connect(state, Namespace(device=[port], next_command=[]))
+    if st is None:
+        do_connect(state, Namespace(device=[port], next_command=[]))
+    else:
+        # Reuse the open connection instead of reopening the port
+        state.transport = st
     do_repl(state, argparse_repl().parse_args([]))
-    do_disconnect(state)
+    if st is None:
+        do_disconnect(state)
     print("\n" + Fore.LIGHTMAGENTA_EX, "R Exiting REPL")
     utils.reset_term_color()
 
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from colorama import Fore
+
+from . import utils
+from .hashcache import HashCache
+from .tree import LocalTree
+
+
+class MpyCrossBuilder:
+    # Compiled modules are stored by the digest of the compiler, the source
+    # path and the source content, so only changed sources are recompiled and
+    # switching back to an earlier version costs nothing. The staging
+    # directory is stable and only touched where its content changes, which
+    # keeps the stat-based hash cache of the following sync effective
+    def __init__(self, mpy_cross_path: str, dir_path: str, jobs: int = 0):
+        self.mpy_cross_path = mpy_cross_path
+        self.dir_path = utils.replace_backslashes(dir_path).rstrip("/")
+        key = hashlib.sha1(os.path.abspath(dir_path).encode("utf-8")).hexdigest()
+        cache_dir = utils.replace_backslashes(utils.get_cache_dir())
+        self.staging_path = f"{cache_dir}/builds/{key[:16]}"
+        self.objects_path = f"{cache_dir}/mpy"
+        self.jobs = jobs or os.cpu_count() or 1
+        self._hashes = HashCache.for_dir(self.dir_path, name="build-hashes")
+
+    def build(self) -> str:
+        print(Fore.YELLOW, "- Compiling with mpy-cross")
+        utils.reset_term_color()
+        tool_id = self._tool_id()
+        tree = LocalTree(self.dir_path)
+        targets = {}
+        pending = {}
+        modules = 0
+        for lfile_rel, lfile_abs in tree.files.items():
+            if lfile_rel != "/main.py" and lfile_rel.endswith(".py"):
+                digest = hashlib.sha1(f"{tool_id}\0{lfile_abs}\0".encode("utf-8"))
+                digest.update(self._hashes.get_digest(lfile_abs, tree.stats[lfile_rel]))
+                object_path = f"{self.objects_path}/{digest.hexdigest()}.mpy"
+                targets[lfile_rel[:-3] + ".mpy"] = object_path
+                modules += 1
+                if not os.path.exists(object_path):
+                    pending[object_path] = lfile_abs
+            else:
+                targets[lfile_rel] = lfile_abs
+        self._hashes.save()
+        os.makedirs(self.objects_path, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            failed = sum(not ok for ok in pool.map(self._compile, pending.items()))
+        self._update_staging(tree.dirs, targets)
+        print(
+            Fore.RED + " E" if failed else Fore.LIGHTGREEN_EX + " ✓",
+            f"Compiled {len(pending) - failed} files, "
+            f"{modules - len(pending)} up to date, {failed} failed",
+        )
+        utils.reset_term_color()
+        return self.staging_path
+
+    def _tool_id(self) -> str:
+        path = shutil.which(self.mpy_cross_path) or self.mpy_cross_path
+        stat = os.stat(path)
+        return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _compile(self, item: tuple[str, str]) -> bool:
+        object_path, src_path = item
+        tmp_path = f"{object_path}.{os.getpid()}.tmp"
+        result = subprocess.run(
+            [self.mpy_cross_path, "-o", tmp_path, src_path], capture_output=True
+        )
+        if result.returncode == 0 and os.path.exists(tmp_path):
+            os.replace(tmp_path, object_path)
+            return True
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # A single print keeps the messages of concurrent failures apart
+        error = result.stderr.decode("utf-8", "replace").rstrip()
+        print(Fore.RED, "E Cannot compile", f"{src_path}\n{error}")
+        utils.reset_term_color()
+        return False
+
+    def _update_staging(self, dirs: dict[str, str], targets: dict[str, str]):
+        sdirs, sfiles = utils.recursive_list_dir(self.staging_path)
+        for sfile_rel, sfile_abs in sfiles.items():
+            if sfile_rel not in targets or not os.path.exists(targets[sfile_rel]):
+                os.remove(sfile_abs)
+        for sdir in sorted(sdirs, reverse=True):
+            if sdir not in dirs:
+                shutil.rmtree(sdirs[sdir], ignore_errors=True)
+        for ldir in dirs:
+            os.makedirs(self.staging_path + ldir, exist_ok=True)
+        for target_rel, src_path in targets.items():
+            if not os.path.exists(src_path):
+                continue
+            dest_path = self.staging_path + target_rel
+            src_stat = os.stat(src_path)
+            if os.path.exists(dest_path):
+                dest_stat = os.stat(dest_path)
+                if (dest_stat.st_size, dest_stat.st_mtime_ns) == (
+                    src_stat.st_size,
+                    src_stat.st_mtime_ns,
+                ):
+                    continue
+            # copy2 keeps the mtime, so unchanged files are recognised next time
+            shutil.copy2(src_path, dest_path)
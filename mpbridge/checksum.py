@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+import hashlib
+import zlib
+
+# Cheapest first. "auto" picks the first one the board supports
+CHECKSUMS = ("crc32", "sha1", "sha256")
+# Stored along with digests in the hashtable, ids must never be reused
+CHECKSUM_IDS = {"sha1": 1, "crc32": 2, "sha256": 3}
+
+
+class Crc32:
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data: bytes):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, "big")
+
+
+def new_hasher(algorithm: str):
+    if algorithm == "crc32":
+        return Crc32()
+    return hashlib.new(algorithm)
+
+
+def choose_checksum(requested: str, available: list[str]) -> str:
+    # The strongest available checksum stands in for a requested one the
+    # board lacks, so asking for SHA never silently ends up with CRC32
+    if requested in available:
+        return requested
+    candidates = [name for name in CHECKSUMS if name in available]
+    if not candidates:
+        raise ValueError("board supports none of " + ", ".join(CHECKSUMS))
+    return candidates[0] if requested == "auto" else candidates[-1]
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import hashlib
+import struct
+import zlib
+from typing import Optional
+
+# Delta records written for `_mpb_patch` on the board:
+#   <kind:u8> <a:u32> <b:u32> [data]
+# COPY copies `b` blocks starting at block `a` of the old file, DATA appends
+# the `a` bytes that follow the record header
+RECORD_HEADER = "<BII"
+RECORD_COPY = ord("C")
+RECORD_DATA = ord("D")
+
+BLOCK_SIZE = 1024
+# Files smaller than this are cheaper to upload in full
+DELTA_MIN_SIZE = 8192
+# Deltas larger than this fraction of the file are not worth patching
+DELTA_MAX_RATIO = 0.75
+
+
+def parse_block_signature(raw: bytes) -> tuple[bytes, Optional[int]]:
+    # 20 bytes of SHA-1, optionally followed by a CRC32 when the board has one
+    if len(raw) == 24:
+        return raw[:20], struct.unpack("<I", raw[20:])[0]
+    return raw[:20], None
+
+
+def _rolling_table(block_size: int) -> list[int]:
+    # Removes the contribution of the byte leaving a CRC32 window
+    zeros = zlib.crc32(b"\0" * block_size)
+    return [zlib.crc32(bytes([b]) + b"\0" * block_size) ^ zeros for b in range(256)]
+
+
+class DeltaBuilder:
+    def __init__(self, block_size: int = BLOCK_SIZE):
+        self.block_size = block_size
+        self.copied_blocks = 0
+        self._records = []
+        self._last_copy = None
+
+    def build(
+        self,
+        data: bytes,
+        signatures: list[tuple[bytes, Optional[int]]],
+        remote_size: int,
+    ) -> bytes:
+        self.copied_blocks = 0
+        self._records = []
+        self._last_copy = None
+        if signatures and all(crc is not None for _, crc in signatures):
+            self._match_rolling(data, signatures, remote_size)
+        else:
+            self._match_aligned(data, signatures)
+        return b"".join(self._records)
+
+    def _match_aligned(self, data: bytes, signatures):
+        bs = self.block_size
+        literal_start = 0
+        for index, (digest, _) in enumerate(signatures):
+            block = data[index * bs : (index + 1) * bs]
+            if block and hashlib.sha1(block).digest() == digest:
+                self._data(data[literal_start : index * bs])
+                self._copy(index)
+                literal_start = index * bs + len(block)
+        self._data(data[literal_start:])
+
+    def _match_rolling(self, data: bytes, signatures, remote_size: int):
+        bs = self.block_size
+        by_crc = {}
+        for index, (_, crc) in enumerate(signatures):
+            by_crc.setdefault(crc, []).append(index)
+        table = _rolling_table(bs)
+        literal_start = 0
+        i = 0
+        crc = None
+        while i + bs <= len(data):
+            if crc is None:
+                crc = zlib.crc32(data[i : i + bs])
+            match = self._find_block(data[i : i + bs], by_crc.get(crc), signatures)
+            if match is not None:
+                self._data(data[literal_start:i])
+                self._copy(match)
+                i += bs
+                literal_start = i
+                crc = None
+                continue
+            if i + bs < len(data):
+                crc = zlib.crc32(data[i + bs : i + bs + 1], crc) ^ table[data[i]]
+            i += 1
+        # The last block of the old file is usually shorter than block_size
+        tail_size = remote_size - (len(signatures) - 1) * bs
+        tail_start = len(data) - tail_size
+        if 0 < tail_size < bs and tail_start >= literal_start:
+            if hashlib.sha1(data[tail_start:]).digest() == signatures[-1][0]:
+                self._data(data[literal_start:tail_start])
+                self._copy(len(signatures) - 1)
+                return
+        self._data(data[literal_start:])
+
+    @staticmethod
+    def _find_block(block: bytes, candidates, signatures) -> Optional[int]:
+        if not candidates:
+            return None
+        digest = hashlib.sha1(block).digest()
+        for index in candidates:
+            if signatures[index][0] == digest:
+                return index
+        return None
+
+    def _copy(self, index: int):
+        self.copied_blocks += 1
+        if self._last_copy is not None and self._last_copy[0] == len(self._records) - 1:
+            _, start, count = self._last_copy
+            if start + count == index:
+                self._records[-1] = struct.pack(
+                    RECORD_HEADER, RECORD_COPY, start, count + 1
+                )
+                self._last_copy = (len(self._records) - 1, start, count + 1)
+                return
+        self._records.append(struct.pack(RECORD_HEADER, RECORD_COPY, index, 1))
+        self._last_copy = (len(self._records) - 1, index, 1)
+
+    def _data(self, data: bytes):
+        if data:
+            self._records.append(struct.pack(RECORD_HEADER, RECORD_DATA, len(data), 0))
+            self._records.append(data)
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import re
+import shutil
+import sys
+import threading
+import time
+from typing import Optional
+
+import serial.tools.list_ports
+from colorama import Fore
+
+from . import utils
+from .profiler import Profiler, print_report, save_reports
+from .serial_transport import COMPRESS_THRESHOLD, ExtendedSerialTransport
+from .transfer import TransferProfile
+from .tree import LocalTree
+
+VID_PID_PATTERN = re.compile(r"([0-9a-fA-F]{4}):([0-9a-fA-F]{4})")
+ANSI_PATTERN = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+PROGRESS_BAR_PATTERN = re.compile(r"\s*\|[█-]+\|")
+REFRESH_SECONDS = 0.2
+
+
+def resolve_ports(spec: str) -> list[str]:
+    # A comma separated list of ports, abbreviations or VID:PID of the boards
+    ports = []
+    for item in spec.split(","):
+        match = VID_PID_PATTERN.fullmatch(item.strip())
+        if match is None:
+            ports.append(utils.port_abbreviation(item.strip()))
+            continue
+        vid, pid = int(match.group(1), 16), int(match.group(2), 16)
+        ports.extend(
+            port.device
+            for port in sorted(serial.tools.list_ports.comports())
+            if port.vid == vid and port.pid == pid
+        )
+    return list(dict.fromkeys(ports))
+
+
+class BoardStatus:
+    def __init__(self, port: str):
+        self.port = port
+        self.line = "Waiting"
+        self.errors: list[str] = []
+        self.error: Optional[str] = None
+        self.changed = 0
+        self.elapsed = 0.0
+        self.done = False
+        self.profiler: Optional[Profiler] = None
+        self._partial = ""
+
+    def feed(self, text: str):
+        parts = re.split(r"[\r\n]", self._partial + text)
+        self._partial = parts.pop()
+        for part in parts:
+            line = PROGRESS_BAR_PATTERN.sub("", ANSI_PATTERN.sub("", part)).strip()
+            if not line:
+                continue
+            self.line = line
+            if line.startswith("E "):
+                self.errors.append(line)
+
+
+class _BoardOutput:
+    # Installed as sys.stdout while boards are synced, output of the worker
+    # threads is turned into one status line per board
+    def __init__(self, stream):
+        self._stream = stream
+        self._boards: dict[int, BoardStatus] = {}
+
+    def attach(self, status: BoardStatus):
+        self._boards[threading.get_ident()] = status
+
+    def write(self, text: str):
+        status = self._boards.get(threading.get_ident())
+        if status is None:
+            return self._stream.write(text)
+        status.feed(text)
+        return len(text)
+
+    def flush(self):
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def sync_boards(
+    ports: list[str],
+    path: str,
+    clean: bool,
+    dry_run: bool,
+    use_hashtable: bool,
+    use_agent: bool = False,
+    compress: bool = False,
+    compress_threshold: int = COMPRESS_THRESHOLD,
+    delta: bool = False,
+    transfer_profile: Optional[TransferProfile] = None,
+    checksum: str = "auto",
+    bundle: bool = False,
+    profile: bool = False,
+    profile_json: Optional[str] = None,
+):
+    print(Fore.YELLOW, f"- Syncing files on {len(ports)} boards with {path}")
+    utils.reset_term_color()
+    # Scanned once and hashed by the first worker needing each checksum, every
+    # board is compared against the same snapshot
+    tree = LocalTree(path)
+    statuses = [BoardStatus(port) for port in ports]
+    output = _BoardOutput(sys.stdout)
+
+    def worker(status: BoardStatus):
+        output.attach(status)
+        started = time.monotonic()
+        if profile or profile_json:
+            status.profiler = Profiler()
+        st = None
+        try:
+            st = ExtendedSerialTransport(
+                device=status.port,
+                use_agent=use_agent,
+                compress=compress,
+                compress_threshold=compress_threshold,
+                delta=delta,
+                transfer_profile=transfer_profile,
+                checksum=checksum,
+                bundle=bundle,
+                profiler=status.profiler,
+            )
+            st.enter_raw_repl_verbose()
+            if clean:
+                st.delete_absent_items(dir_path=path, dry=dry_run, tree=tree)
+            # Boards are only pushed to, pulling from several of them into one
+            # directory would mix their files
+            status.changed = st.sync_with_dir(
+                dir_path=path,
+                dry=dry_run,
+                push=True,
+                use_hashtable=use_hashtable,
+                tree=tree,
+            )
+            st.exit_raw_repl_verbose()
+        except Exception as e:
+            status.error = str(e) or type(e).__name__
+        finally:
+            if st is not None:
+                st.close()
+            status.elapsed = time.monotonic() - started
+            status.done = True
+
+    threads = [
+        threading.Thread(target=worker, args=(status,), daemon=True)
+        for status in statuses
+    ]
+    sys.stdout = output
+    try:
+        for thread in threads:
+            thread.start()
+        _show_progress(output, statuses, threads)
+    finally:
+        sys.stdout = output._stream
+    _print_summary(statuses)
+    if profile or profile_json:
+        _report_profiles(statuses, profile_json)
+
+
+def _show_progress(output, statuses: list[BoardStatus], threads):
+    stream = output._stream
+    redraw = stream.isatty()
+    width = max(len(status.port) for status in statuses)
+    reported = set()
+    drawn = False
+    while True:
+        alive = any(thread.is_alive() for thread in threads)
+        if redraw:
+            columns = shutil.get_terminal_size().columns - 1
+            if drawn:
+                stream.write(f"\x1b[{len(statuses)}A")
+            for status in statuses:
+                line = f" {status.port.ljust(width)}  {status.line}"
+                stream.write(f"\r{line[:columns]}\x1b[K\n")
+            drawn = True
+        else:
+            # Plain output when redirected, one line per finished board
+            for status in statuses:
+                if status.done and status.port not in reported:
+                    reported.add(status.port)
+                    stream.write(f" {status.port.ljust(width)}  {status.line}\n")
+        stream.flush()
+        if not alive:
+            return
+        time.sleep(REFRESH_SECONDS)
+
+
+def _print_summary(statuses: list[BoardStatus]):
+    width = max(len(status.port) for status in statuses)
+    failed = 0
+    for status in statuses:
+        if status.error is not None:
+            failed += 1
+            print(Fore.RED, "E", status.port.ljust(width), status.error)
+        else:
+            print(
+                Fore.LIGHTGREEN_EX,
+                "✓",
+                status.port.ljust(width),
+                f"{status.changed} files changed in {status.elapsed:.1f}s",
+            )
+        for error in status.errors:
+            print(Fore.RED, "   ", error)
+    color = Fore.RED if failed else Fore.LIGHTGREEN_EX
+    print(color, f"- {len(statuses) - failed} of {len(statuses)} boards synced")
+    utils.reset_term_color()
+
+
+def _report_profiles(statuses: list[BoardStatus], json_path: Optional[str]):
+    reports = {status.port: status.profiler.to_dict() for status in statuses}
+    for port, data in reports.items():
+        print_report(data, title=port)
+    if json_path is not None:
+        save_reports(json_path, {"boards": reports})
@@ -12,13 +12,13 @@ from watchdog.events import (
     DirModifiedEvent,
 )
 
-from .serial_transport import ExtendedSerialTransport
+from .uploader import UploadQueue
 from .utils import remove_prefix, replace_backslashes
 
 
 class EventHandler(FileSystemEventHandler):
-    def __init__(self, st: ExtendedSerialTransport, base_path: str) -> None:
-        self.st = st
+    def __init__(self, queue: UploadQueue, base_path: str) -> None:
+        self.queue = queue
         self.base_path = replace_backslashes(base_path)
 
     def dispatch(self, event):
@@ -30,9 +30,9 @@ class EventHandler(FileSystemEventHandler):
         dest_path = replace_backslashes(event.dest_path)
         rel_dest_path = remove_prefix(dest_path, self.base_path)
         if ".goutputstream-" in src_path:
-            self.st.fs_verbose_put(dest_path, rel_dest_path)
+            self.queue.put(rel_dest_path)
         else:
-            self.st.fs_verbose_rename(src_path, rel_dest_path)
+            self.queue.move(src_path, rel_dest_path, is_dir=event.is_directory)
         super().on_moved(event)
 
     def on_created(self, event: Union[DirCreatedEvent, FileCreatedEvent]):
@@ -41,17 +41,14 @@ class EventHandler(FileSystemEventHandler):
         if ".goutputstream-" in src_path:
             return
         if event.is_directory:
-            self.st.fs_verbose_mkdir(rel_src_path)
+            self.queue.mkdir(rel_src_path)
         else:
-            self.st.fs_verbose_put(src_path, rel_src_path)
+            self.queue.put(rel_src_path, created=True)
         super().on_created(event)
 
     def on_deleted(self, event: Union[DirDeletedEvent, FileDeletedEvent]):
         src_path = remove_prefix(replace_backslashes(event.src_path), self.base_path)
-        try:
-            self.st.fs_verbose_rm(src_path)
-        except:
-            self.st.fs_verbose_rmdir(src_path)
+        self.queue.delete(src_path, is_dir=event.is_directory)
         super().on_deleted(event)
 
     def on_modified(self, event: Union[FileModifiedEvent, DirModifiedEvent]):
@@ -60,4 +57,4 @@ class EventHandler(FileSystemEventHandler):
         if ".goutputstream-" in src_path:
             return
         if not event.is_directory:
-            self.st.fs_verbose_put(src_path, rel_src_path)
+            self.queue.put(rel_src_path)
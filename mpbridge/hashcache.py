@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+
+from . import utils
+
+CACHE_VERSION = 1
+# Files modified this recently may still change within the same mtime tick,
+# so their digests are not persisted
+RACY_WINDOW_NS = 2_000_000_000
+
+
+class HashCache:
+    def __init__(self, index_path: str, algorithm: str = "sha1"):
+        self._index_path = index_path
+        self.algorithm = algorithm
+        self._entries: dict[str, list] = {}
+        self._used: set[str] = set()
+        self._dirty = False
+        self.load()
+
+    @classmethod
+    def for_dir(
+        cls, dir_path: str, algorithm: str = "sha1", name: str = "hashes"
+    ) -> HashCache:
+        # Each user of a directory gets its own index under `name`, as saving
+        # forgets the files that were not looked up
+        dir_path = os.path.abspath(dir_path)
+        key = hashlib.sha1(dir_path.encode("utf-8")).hexdigest()[:16]
+        # SHA-1 keeps the index name used before other checksums existed
+        suffix = "" if algorithm == "sha1" else f"-{algorithm}"
+        return cls(
+            os.path.join(utils.get_cache_dir(), f"{name}-{key}{suffix}.json"),
+            algorithm=algorithm,
+        )
+
+    def load(self):
+        try:
+            with open(self._index_path, "r") as file:
+                index = json.load(file)
+            if index.get("version") == CACHE_VERSION:
+                self._entries = index["entries"]
+        except (OSError, ValueError, KeyError):
+            self._entries = {}
+
+    def save(self):
+        # Forget files that were not looked up, e.g. deleted or renamed ones
+        stale = self._entries.keys() - self._used
+        if stale:
+            for path in stale:
+                del self._entries[path]
+            self._dirty = True
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self._index_path), exist_ok=True)
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"version": CACHE_VERSION, "entries": self._entries}, file)
+        os.replace(tmp_path, self._index_path)
+        self._dirty = False
+
+    def get_digest(self, path: str, stat: os.stat_result | None = None) -> bytes:
+        stat = stat or os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        self._used.add(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry[:3] == key:
+            return bytes.fromhex(entry[3])
+        digest = utils.get_file_digest(path, self.algorithm)
+        if time.time_ns() - stat.st_mtime_ns > RACY_WINDOW_NS:
+            self._entries[path] = key + [digest.hex()]
+            self._dirty = True
+        return digest
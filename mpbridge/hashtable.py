@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import struct
+from typing import Optional
+
+from .checksum import CHECKSUM_IDS
+from .utils import unpack_length_prefixed
+
+HASHTABLE_PATH = "/mpbridge.hashtable"
+# Version 3 layout:
+#   header: <magic:4s> <version:u8>
+#   record: <algo:u8> <digest_len:u8> <size:u32> <mtime:u32> <path_len:u16>
+#           <path> <digest>
+# Records are appended as entries change and the last record of a path wins.
+# Algo is one of CHECKSUM_IDS, a record with algo 0 removes the path. Mtime is
+# the board clock the file was last written at, 0 when unknown. Version 2
+# records have no mtime
+MAGIC = b"MPBH"
+VERSION = 3
+HEADER = "<4sB"
+RECORDS = {2: "<BBIH", 3: "<BBIIH"}
+ALGO_REMOVED = 0
+# The file is rewritten once superseded records outnumber live ones by this
+# factor, otherwise changes are appended
+COMPACT_RATIO = 2
+COMPACT_MIN_RECORDS = 64
+
+
+def encode_record(
+    path: str, algo: int, size: int, digest: bytes, mtime: int = 0
+) -> bytes:
+    path = path.encode("utf-8")
+    header = struct.pack(RECORDS[VERSION], algo, len(digest), size, mtime, len(path))
+    return header + path + digest
+
+
+class HashTable:
+    # Digests of the files on the board, stored on the board itself. An entry
+    # is only trusted while the file still has the size it was hashed at, and
+    # when asked to, the mtime it was recorded with
+    def __init__(self):
+        # path: (algo, size, digest, mtime)
+        self.entries: dict[str, tuple[int, Optional[int], bytes, int]] = {}
+        self._records = 0
+        self._changes: dict[str, bytes] = {}
+        # Not stored yet, written by an older mpbridge or unreadable, so the
+        # file is written in full
+        self._rewrite = True
+
+    @classmethod
+    def parse(cls, data: bytes) -> HashTable:
+        table = cls()
+        header_size = struct.calcsize(HEADER)
+        if data[:4] != MAGIC:
+            table._parse_legacy(data)
+            return table
+        version = struct.unpack(HEADER, data[:header_size])[1]
+        if version not in RECORDS:
+            table._rewrite = True
+            return table
+        # Older versions are upgraded on the next write
+        table._rewrite = version != VERSION
+        record = RECORDS[version]
+        record_size = struct.calcsize(record)
+        i = header_size
+        while i + record_size <= len(data):
+            algo, digest_len, size, *mtime, path_len = struct.unpack(
+                record, data[i : i + record_size]
+            )
+            i += record_size
+            path = data[i : i + path_len].decode("utf-8")
+            digest = data[i + path_len : i + path_len + digest_len]
+            i += path_len + digest_len
+            if len(digest) != digest_len:
+                # Cut short by an interrupted append
+                table._rewrite = True
+                break
+            table._records += 1
+            if algo == ALGO_REMOVED:
+                table.entries.pop(path, None)
+            else:
+                table.entries[path] = (algo, size, digest, mtime[0] if mtime else 0)
+        if i != len(data):
+            table._rewrite = True
+        return table
+
+    def _parse_legacy(self, data: bytes):
+        # <path_len:u8> <path> <digest_len:u8> <digest>, sizes are unknown
+        try:
+            items = list(unpack_length_prefixed("B", data))
+            for path, digest in zip(items[::2], items[1::2]):
+                self.entries[bytes(path).decode("utf-8")] = (
+                    CHECKSUM_IDS["sha1"],
+                    None,
+                    bytes(digest),
+                    0,
+                )
+        except (struct.error, UnicodeDecodeError):
+            self.entries.clear()
+
+    def get(
+        self, path: str, size: int, algorithm: str, mtime: Optional[int] = None
+    ) -> Optional[bytes]:
+        # With an mtime, the entry must have been recorded with that same one
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != CHECKSUM_IDS[algorithm]:
+            return None
+        if mtime is not None and not (mtime and entry[3] == mtime):
+            return None
+        return entry[2] if entry[1] in (None, size) else None
+
+    def set(
+        self, path: str, size: int, digest: bytes, algorithm: str, mtime: int = 0
+    ):
+        entry = (CHECKSUM_IDS[algorithm], size, digest, mtime)
+        if self.entries.get(path) == entry:
+            return
+        self.entries[path] = entry
+        self._changes[path] = encode_record(path, *entry)
+
+    def discard(self, path: str):
+        if self.entries.pop(path, None) is not None:
+            self._changes[path] = encode_record(path, ALGO_REMOVED, 0, b"")
+
+    @property
+    def dirty(self) -> bool:
+        return self._rewrite or bool(self._changes)
+
+    def take_update(self) -> tuple[bool, bytes]:
+        # Returns (append, data) to bring the stored file up to date
+        records = self._records + len(self._changes)
+        append = not self._rewrite and not (
+            records > COMPACT_MIN_RECORDS
+            and records > len(self.entries) * COMPACT_RATIO
+        )
+        if append:
+            data = b"".join(self._changes.values())
+            self._records = records
+        else:
+            data = struct.pack(HEADER, MAGIC, VERSION) + b"".join(
+                encode_record(path, *entry) for path, entry in self.entries.items()
+            )
+            self._records = len(self.entries)
+        self._changes.clear()
+        self._rewrite = False
+        return append, data
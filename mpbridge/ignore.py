@@ -1,50 +1,168 @@
+from __future__ import annotations
+
 import os
+import re
+from typing import Optional
 
 from . import utils
 
+IGNORE_FILE_NAME = "mpbridge.ignore"
+# Helper files created by mpbridge itself are never synced
+RESERVED_SUFFIXES = (
+    "mpbridge.hashtable",
+    "mpbridge.journal",
+    ".mpbz",
+    ".mpbd",
+    ".mpbp",
+    ".mpbt",
+)
+GLOB_CHARS = frozenset("*?[")
+
+
+def glob_to_regex(pattern: str) -> str:
+    out = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if char == "*":
+            out.append("[^/]*")
+        elif char == "?":
+            out.append("[^/]")
+        elif char == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1 : end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[" + body.replace("\\", "\\\\") + "]")
+            i = end
+        else:
+            out.append(re.escape(char))
+        i += 1
+    return "".join(out)
+
 
 class IgnoreStorage:
-    def __init__(self, dir_path: str):
-        self._dirs = []
-        self._files = []
+    # Rules are numbered in the order they are loaded and the last matching rule
+    # wins, so a negated rule can re-include paths ignored by an earlier one.
+    # Literal paths are looked up in dicts, glob rules are compiled into one
+    # regex per kind whose alternatives are ordered newest first
+    def __init__(self, dir_path: str, load: bool = True):
         self._root_dir = dir_path.rstrip("/")
-        self.load()
+        self._count = 0
+        self._literal_dirs: dict[str, tuple[int, bool]] = {}
+        self._literal_files: dict[str, tuple[int, bool]] = {}
+        self._glob_dirs: list[tuple[int, bool, str]] = []
+        self._glob_files: list[tuple[int, bool, str]] = []
+        self._dir_regex = None
+        self._file_regex = None
+        self._negated: dict[str, bool] = {}
+        self._dir_cache: dict[str, bool] = {}
+        if load:
+            self.load()
 
     def load(self):
         for subdir, dirs, files in os.walk(self._root_dir, followlinks=True):
             subdir = utils.replace_backslashes(subdir)
             for file in files:
-                if file == "mpbridge.ignore":
-                    self._load_ignore_file(abs_dir=subdir.rstrip("/"))
+                if file == IGNORE_FILE_NAME:
+                    self.load_ignore_file(abs_dir=subdir.rstrip("/"))
 
-    def _load_ignore_file(self, abs_dir: str):
+    def load_ignore_file(self, abs_dir: str):
         rel_dir = utils.remove_prefix(abs_dir, self._root_dir)
         try:
-            with open(f"{abs_dir}/mpbridge.ignore", "r") as file:
+            with open(f"{abs_dir}/{IGNORE_FILE_NAME}", "r") as file:
                 for line in utils.replace_backslashes(file.read()).split("\n"):
-                    if not "".join(line.split()):
-                        continue
-                    line = "/" + line.lstrip("/")
-                    if line.endswith("/"):
-                        self._dirs.append(f"{rel_dir}{line.rstrip('/')}/")
-                    else:
-                        self._files.append(f"{rel_dir}{line}")
+                    self.add_rule(line.rstrip(), rel_dir=rel_dir)
         except FileNotFoundError:
             pass
         except:
             raise RuntimeError("Invalid mpbridge.ignore file")
 
+    def add_rule(self, rule: str, rel_dir: str = ""):
+        if not rule.strip() or rule.startswith("#"):
+            return
+        negate = rule.startswith("!")
+        rule = rule[1:] if negate else rule
+        is_dir = rule.endswith("/")
+        anchored = "/" in rule.rstrip("/")
+        rule = rule.strip("/")
+        if not rule:
+            return
+        index = self._count
+        self._count += 1
+        if GLOB_CHARS.isdisjoint(rule):
+            literals = self._literal_dirs if is_dir else self._literal_files
+            literals[f"{rel_dir}/{rule}"] = (index, negate)
+        else:
+            # Like .gitignore, a glob without a slash matches at any depth
+            prefix = re.escape(rel_dir) + ("/" if anchored else "/(?:.*/)?")
+            globs = self._glob_dirs if is_dir else self._glob_files
+            globs.append((index, negate, prefix + glob_to_regex(rule)))
+            self._dir_regex = self._file_regex = None
+        self._dir_cache.clear()
+
     def match_dir(self, rel_path: str) -> bool:
-        rel_path = rel_path.rstrip("/") + "/"
-        for ignored_dir in self._dirs:
-            if rel_path.startswith(ignored_dir) or rel_path == ignored_dir:
-                return True
-        return False
+        rel_path = rel_path.rstrip("/")
+        if not rel_path:
+            return False
+        cached = self._dir_cache.get(rel_path)
+        if cached is None:
+            # A directory inside an ignored one is ignored whatever its rules say
+            parent = rel_path.rpartition("/")[0]
+            cached = self.match_dir(parent) or self._decide(
+                rel_path, self._literal_dirs, self._get_dir_regex()
+            )
+            self._dir_cache[rel_path] = cached
+        return cached
 
     def match_file(self, rel_path: str) -> bool:
-        if rel_path.endswith("mpbridge.hashtable"):
+        if rel_path.endswith(RESERVED_SUFFIXES):
+            return True
+        if self.match_dir(rel_path.rpartition("/")[0]):
             return True
-        for ignored_dir in self._dirs:
-            if rel_path.startswith(ignored_dir):
-                return True
-        return rel_path in self._files
+        return self._decide(rel_path, self._literal_files, self._get_file_regex())
+
+    def prune(self, dirs: dict, files: dict) -> tuple[dict, dict]:
+        return (
+            {path: value for path, value in dirs.items() if not self.match_dir(path)},
+            {path: value for path, value in files.items() if not self.match_file(path)},
+        )
+
+    def _decide(self, rel_path: str, literals: dict, regex) -> bool:
+        rule = literals.get(rel_path)
+        if regex is not None:
+            match = regex.fullmatch(rel_path)
+            if match is not None:
+                index = int(match.lastgroup[1:])
+                if rule is None or index > rule[0]:
+                    rule = (index, self._negated[match.lastgroup])
+        return rule is not None and not rule[1]
+
+    def _get_dir_regex(self):
+        if self._dir_regex is None:
+            self._dir_regex = self._compile(self._glob_dirs)
+        return self._dir_regex
+
+    def _get_file_regex(self):
+        if self._file_regex is None:
+            self._file_regex = self._compile(self._glob_files)
+        return self._file_regex
+
+    def _compile(self, globs: list) -> Optional[re.Pattern]:
+        if not globs:
+            return None
+        for index, negate, _ in globs:
+            self._negated[f"r{index}"] = negate
+        return re.compile(
+            "|".join(
+                f"(?P<r{index}>{regex})" for index, _, regex in reversed(globs)
+            )
+        )
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import hashlib
+import struct
+
+JOURNAL_PATH = "/mpbridge.journal"
+# Version 1 layout:
+#   header:   <magic:4s> <version:u8> <state:20s> <count:u32>
+#   entry:    <path_len:u16> <path>, `count` times in the planned order
+#   progress: <index:u32> of every finished entry, appended as the sync goes
+# A progress record cut short by an interruption is ignored
+MAGIC = b"MPBJ"
+VERSION = 1
+HEADER = "<4sB20sI"
+ENTRY = "<H"
+PROGRESS = "<I"
+
+
+def local_state(sizes: dict[str, int], digests: dict[str, bytes]) -> bytes:
+    # Fingerprint of the local files a plan was made for
+    state = hashlib.sha1()
+    for path in sorted(digests):
+        encoded = path.encode("utf-8")
+        state.update(struct.pack("<HI", len(encoded), sizes[path]) + encoded)
+        state.update(digests[path])
+    return state.digest()
+
+
+class Journal:
+    # Files a sync is about to write on the board, stored on the board itself.
+    # Every other file had the local content when the plan was made, so an
+    # interrupted sync can be resumed without hashing them again as long as
+    # the local files are still the same
+    def __init__(self, state: bytes, paths: list[str]):
+        self.state = state
+        self.paths = paths
+        self.done: set[int] = set()
+        self._index = {path: i for i, path in enumerate(paths)}
+        self._progress = bytearray()
+
+    @classmethod
+    def parse(cls, data: bytes) -> Journal:
+        header_size = struct.calcsize(HEADER)
+        magic, version, state, count = struct.unpack(HEADER, data[:header_size])
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("unsupported journal")
+        entry_size = struct.calcsize(ENTRY)
+        paths = []
+        i = header_size
+        for _ in range(count):
+            path_len = struct.unpack(ENTRY, data[i : i + entry_size])[0]
+            i += entry_size
+            paths.append(data[i : i + path_len].decode("utf-8"))
+            i += path_len
+        if i > len(data):
+            raise ValueError("truncated journal")
+        journal = cls(state, paths)
+        progress_size = struct.calcsize(PROGRESS)
+        while i + progress_size <= len(data):
+            journal.done.add(struct.unpack(PROGRESS, data[i : i + progress_size])[0])
+            i += progress_size
+        return journal
+
+    def encode(self) -> bytes:
+        data = bytearray(
+            struct.pack(HEADER, MAGIC, VERSION, self.state, len(self.paths))
+        )
+        for path in self.paths:
+            encoded = path.encode("utf-8")
+            data += struct.pack(ENTRY, len(encoded)) + encoded
+        return bytes(data)
+
+    def pending(self) -> list[str]:
+        return [path for i, path in enumerate(self.paths) if i not in self.done]
+
+    def finish(self, path: str):
+        i = self._index.get(path)
+        if i is not None and i not in self.done:
+            self.done.add(i)
+            self._progress += struct.pack(PROGRESS, i)
+
+    def take_progress(self) -> bytes:
+        # Progress records not stored on the board yet
+        data = bytes(self._progress)
+        self._progress.clear()
+        return data
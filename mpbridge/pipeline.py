@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import os
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Callable, Iterable, Iterator, NamedTuple, TypeVar
+
+T = TypeVar("T")
+
+# Host work (reading, compressing and delta encoding files) runs on these
+# workers while the serial link is busy with earlier files
+WORKERS = min(8, os.cpu_count() or 1)
+# Bounds the memory held by prepared payloads the link has not taken yet
+MAX_AHEAD_BYTES = 4 * 1024 * 1024
+# Larger files are streamed from disk by the serial stage instead
+MAX_PREPARED_FILE = 1024 * 1024
+
+
+class Payload(NamedTuple):
+    data: bytes
+    compressed: bool
+    # Size of the file once written on the board
+    size: int
+
+
+def prefetch(
+    executor: Executor,
+    items: Iterable[T],
+    prepare: Callable[[T], object],
+    size_of: Callable[[T], int],
+    max_ahead: int = MAX_AHEAD_BYTES,
+) -> Iterator[tuple[T, Future]]:
+    # Yields (item, future of prepare(item)) in order. The following items
+    # are prepared on the executor meanwhile, as long as they fit in
+    # `max_ahead` bytes. The next item is always prepared
+    queue: deque[tuple[T, int, Future]] = deque()
+    ahead = 0
+    for item in items:
+        size = size_of(item)
+        while queue and ahead + size > max_ahead:
+            done, done_size, future = queue.popleft()
+            ahead -= done_size
+            yield done, future
+        queue.append((item, size, executor.submit(prepare, item)))
+        ahead += size
+    while queue:
+        done, _, future = queue.popleft()
+        yield done, future
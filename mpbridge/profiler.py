@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import json
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from colorama import Fore
+
+from . import utils
+
+SLOWEST_FILES = 10
+
+
+class CountingSerial:
+    # Stands in for the serial port of a transport to count the bytes sent
+    # and received, everything else is passed through
+    def __init__(self, serial, profiler: Profiler):
+        self._serial = serial
+        self._profiler = profiler
+
+    def read(self, size=1):
+        data = self._serial.read(size)
+        self._profiler.bytes_in += len(data)
+        return data
+
+    def write(self, data):
+        self._profiler.bytes_out += len(data)
+        return self._serial.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._serial, name)
+
+
+class Profiler:
+    # Time is charged to the innermost running phase only, so nested phases
+    # such as progress output are not counted twice. Time outside any phase
+    # is reported as "other"
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.execs = 0
+        self.agent_requests = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.phases: dict[str, float] = {}
+        # (path, seconds, bytes) of every file transfer
+        self.files: list[tuple[str, float, int]] = []
+        self._stack: list[str] = []
+        self._started = self._mark = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str, path: Optional[str] = None):
+        self._switch()
+        self._stack.append(name)
+        started = time.perf_counter()
+        traffic = self.bytes_in + self.bytes_out
+        try:
+            yield
+        finally:
+            self._switch()
+            self._stack.pop()
+            if path is not None:
+                self.files.append(
+                    (
+                        path,
+                        time.perf_counter() - started,
+                        self.bytes_in + self.bytes_out - traffic,
+                    )
+                )
+
+    def _switch(self):
+        now = time.perf_counter()
+        if self._stack:
+            name = self._stack[-1]
+            self.phases[name] = self.phases.get(name, 0.0) + now - self._mark
+        self._mark = now
+
+    def to_dict(self) -> dict:
+        self._switch()
+        seconds = self._mark - self._started
+        phases = dict(sorted(self.phases.items(), key=lambda p: p[1], reverse=True))
+        phases["other"] = max(seconds - sum(self.phases.values()), 0.0)
+        slowest = sorted(self.files, key=lambda f: f[1], reverse=True)
+        return {
+            "seconds": seconds,
+            "round_trips": self.execs + self.agent_requests,
+            "execs": self.execs,
+            "agent_requests": self.agent_requests,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "phases": phases,
+            "slowest_files": [
+                {"path": path, "seconds": seconds, "bytes": size}
+                for path, seconds, size in slowest[:SLOWEST_FILES]
+            ],
+        }
+
+    def report(self, json_path: Optional[str] = None, title: Optional[str] = None):
+        data = self.to_dict()
+        print_report(data, title)
+        if json_path is not None:
+            save_reports(json_path, data)
+
+
+def print_report(data: dict, title: Optional[str] = None):
+    print(
+        Fore.YELLOW,
+        f"- Profile{' of ' + title if title else ''}: {data['seconds']:.2f}s,",
+        f"{data['round_trips']} round trips,",
+        f"{format_size(data['bytes_out'])} sent,",
+        f"{format_size(data['bytes_in'])} received",
+    )
+    for name, seconds in data["phases"].items():
+        share = seconds * 100 / max(data["seconds"], 1e-9)
+        print(Fore.LIGHTWHITE_EX, f"  {name.ljust(18)} {seconds:8.2f}s {share:4.0f}%")
+    if data["slowest_files"]:
+        print(Fore.YELLOW, "- Slowest files")
+        for file in data["slowest_files"]:
+            print(
+                Fore.LIGHTWHITE_EX,
+                f"  {file['seconds']:8.2f}s {format_size(file['bytes']).rjust(9)}",
+                file["path"],
+            )
+    utils.reset_term_color()
+
+
+def save_reports(path: str, data: dict):
+    with open(path, "w") as file:
+        json.dump(data, file, indent=2)
+    print(Fore.YELLOW, "- Saved profile to", path)
+    utils.reset_term_color()
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
@@ -1,45 +1,534 @@
-import itertools
+import ast
+import errno
+import hashlib
+import io
 import os
-from contextlib import suppress
+import re
+import shutil
+import struct
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext, suppress
+from typing import Optional
 
 from colorama import Fore
 from mpremote.transport_serial import SerialTransport, TransportError
 
 from . import utils
-from .ignore import IgnoreStorage
-from .utils import unpack_length_prefixed
+from .agent import DeviceAgent
+from .delta import (
+    BLOCK_SIZE,
+    DELTA_MAX_RATIO,
+    DELTA_MIN_SIZE,
+    DeltaBuilder,
+    parse_block_signature,
+)
+from .checksum import choose_checksum
+from .hashcache import HashCache
+from .hashtable import HASHTABLE_PATH, HashTable
+from .ignore import RESERVED_SUFFIXES
+from .journal import JOURNAL_PATH, Journal, local_state
+from .pipeline import MAX_PREPARED_FILE, WORKERS, Payload, prefetch
+from .profiler import CountingSerial, Profiler
+from .transfer import (
+    ACK,
+    MAX_CHUNK_SIZE,
+    TRANSFER_PROFILES,
+    TransferInterrupted,
+    TransferProfile,
+    auto_profile,
+    read_exact,
+    send_windowed,
+)
+from .tree import LocalTree, RemoteTree
 
-RECURSIVE_LS = """
-from os import ilistdir
+# Walks the tree under `root` without recursion and reports one line per entry:
+#   <D|F> <size> <mtime> <path>
+# Newlines and backslashes in names are escaped. Lines are emitted in small
+# batches, either printed or framed on sys.stdout.buffer like `_mpb_send`
+LS_FUNCS = r"""
+import os, sys
+from struct import pack
 from gc import collect
-def iter_dir(dir_path):
-    collect()
-    for item in ilistdir(dir_path):
-        if dir_path[-1] != "/":
-            dir_path += "/"
-        idir = f"{dir_path}{item[0]}"
-        if item[1] == 0x8000:
-            yield idir, True, item[3]
-        else:
-            yield from iter_dir(idir)
-            yield idir, False, 0
-for item in iter_dir("/"):
-    print(item, end=",")
+def _mpb_q(p):
+    if "\\" in p or "\n" in p or "\r" in p:
+        return p.replace("\\", "\\\\").replace("\n", "\\n").replace("\r", "\\r")
+    return p
+def _mpb_print(t):
+    print(t, end="")
+def _mpb_frame(t):
+    b = t.encode()
+    sys.stdout.buffer.write(b"\x06" + pack("<I", len(b)))
+    sys.stdout.buffer.write(b)
+def _mpb_ls(root, emit):
+    st = [root]
+    out = []
+    n = 0
+    while st:
+        d = st.pop()
+        for e in os.ilistdir(d):
+            p = d.rstrip("/") + "/" + e[0]
+            s = os.stat(p)
+            if e[1] == 0x4000:
+                st.append(p)
+                t = "D 0 %d %s\n" % (s[8], _mpb_q(p))
+            else:
+                t = "F %d %d %s\n" % (s[6], s[8], _mpb_q(p))
+            out.append(t)
+            n += len(t)
+            if n >= 512:
+                emit("".join(out))
+                out = []
+                n = 0
+        collect()
+    if out:
+        emit("".join(out))
+    emit("")
 """
 
-SHA1_FUNC = """
-from hashlib import sha1
+# Imported or defined as `_mpb_hasher` ahead of DIGEST_FUNCS, depending on the
+# checksum negotiated for the session
+HASHERS = {
+    "crc32": """
+from binascii import crc32
+class _mpb_hasher:
+    def __init__(self):
+        self.c = 0
+    def update(self, d):
+        self.c = crc32(d, self.c)
+    def digest(self):
+        return self.c.to_bytes(4, "big")
+""",
+    "sha1": "from hashlib import sha1 as _mpb_hasher\n",
+    "sha256": "from hashlib import sha256 as _mpb_hasher\n",
+}
+
+DIGEST_FUNCS = """
+import os
+from binascii import hexlify
 from gc import collect
+from time import time
 b = bytearray(1024)
 mv = memoryview(b)
-def get_sha1(path):
-    h = sha1()
+def _mpb_digest(path):
+    h = _mpb_hasher()
     with open(path,"rb") as f:
         while s := f.readinto(b):
             h.update(mv[:s])
     collect()
     return h.digest()
+def print_digests(paths):
+    for path in paths:
+        try:
+            print(hexlify(_mpb_digest(path)).decode())
+        except OSError:
+            print()
+def print_mtimes(paths):
+    print(int(time()))
+    for path in paths:
+        try:
+            print(os.stat(path)[8])
+        except OSError:
+            print()
+"""
+
+CHECKSUM_PROBE = """
+_mpb_r = []
+try:
+    from binascii import crc32
+    _mpb_r.append("crc32")
+except ImportError:
+    pass
+try:
+    import hashlib
+    _mpb_r.extend(n for n in ("sha1", "sha256") if hasattr(hashlib, n))
+except ImportError:
+    pass
+print(" ".join(_mpb_r))
+"""
+
+STREAM_FUNCS = """
+import os, sys
+from struct import pack
+try:
+    from micropython import kbd_intr
+except ImportError:
+    kbd_intr = lambda c: None
+def _mpb_recv(path, size, chunk):
+    i = sys.stdin.buffer
+    o = sys.stdout.buffer
+    mv = memoryview(bytearray(chunk))
+    e = None
+    t = path + ".mpbt"
+    kbd_intr(-1)
+    try:
+        with open(t, "wb") as f:
+            o.write(b"\\x06")
+            while size:
+                k = min(size, chunk)
+                i.readinto(mv[:1])
+                if mv[0] != 6:
+                    e = e or OSError("transfer aborted")
+                    break
+                i.readinto(mv[:k])
+                if e is None:
+                    try:
+                        f.write(mv[:k])
+                    except OSError as x:
+                        e = x
+                size -= k
+                o.write(b"\\x06")
+    finally:
+        kbd_intr(3)
+    if e:
+        os.remove(t)
+        raise e
+    os.rename(t, path)
+def _mpb_send(path, chunk):
+    o = sys.stdout.buffer
+    mv = memoryview(bytearray(chunk))
+    with open(path, "rb") as f:
+        o.write(b"\\x06" + pack("<I", os.stat(path)[6]))
+        while n := f.readinto(mv):
+            o.write(mv[:n])
+"""
+
+CALIBRATE_FUNCS = """
+import gc, sys
+_mpb_o = getattr(sys.stdout, "buffer", None)
+gc.collect()
+print(gc.mem_free(), int(hasattr(sys.stdin, "buffer") and _mpb_o is not None))
+"""
+# Bytes echoed by the board to estimate the link throughput
+CALIBRATE_SIZE = 2048
+
+COMPRESSION_FUNCS = """
+import os, io
+try:
+    from deflate import DeflateIO, ZLIB
+    _mpb_dio = lambda f: DeflateIO(f, ZLIB)
+    try:
+        DeflateIO(io.BytesIO(), ZLIB, 10).write(b"x")
+        _mpb_cio = lambda f: DeflateIO(f, ZLIB, 10)
+    except Exception:
+        _mpb_cio = None
+except ImportError:
+    _mpb_cio = None
+    try:
+        from zlib import DecompIO
+        _mpb_dio = lambda f: DecompIO(f, 10)
+    except ImportError:
+        _mpb_dio = None
+def _mpb_copy(r, w):
+    b = bytearray(512)
+    mv = memoryview(b)
+    while n := r.readinto(b):
+        w.write(mv[:n])
+def _mpb_inflate(src, dest):
+    t = dest + ".mpbt"
+    with open(src, "rb") as f:
+        with open(t, "wb") as o:
+            _mpb_copy(_mpb_dio(f), o)
+    os.remove(src)
+    os.rename(t, dest)
+def _mpb_deflate(src, dest, threshold):
+    if os.stat(src)[6] < threshold:
+        return 0
+    with open(src, "rb") as f:
+        with open(dest, "wb") as o:
+            c = _mpb_cio(o)
+            _mpb_copy(f, c)
+            c.close()
+    if os.stat(dest)[6] >= os.stat(src)[6]:
+        os.remove(dest)
+        return 0
+    return 1
+print(("d" if _mpb_dio else "") + ("c" if _mpb_cio else ""))
+"""
+
+# Unpacks a stream of <count:u32> followed by <path_len:u16> <size:u32> <path>
+# <data> records, optionally zlib compressed, straight from stdin into files.
+# Raw chunks are acknowledged as they are read, like in `_mpb_recv`, and the
+# paths that could not be written are returned once the stream has ended
+BUNDLE_FUNCS = """
+import io, os, sys
+from struct import unpack
+try:
+    from micropython import kbd_intr
+except ImportError:
+    kbd_intr = lambda c: None
+class _mpb_In(getattr(io, "IOBase", object)):
+    def __init__(self, size, chunk):
+        self.n = size
+        self.m = memoryview(bytearray(chunk))
+        self.p = self.e = 0
+    def _fill(self):
+        k = min(self.n, len(self.m))
+        sys.stdin.buffer.readinto(self.m[:1])
+        if self.m[0] != 6:
+            raise OSError("transfer aborted")
+        sys.stdin.buffer.readinto(self.m[:k])
+        self.n -= k
+        self.p = 0
+        self.e = k
+        sys.stdout.buffer.write(b"\\x06")
+    def readinto(self, b):
+        if self.p == self.e:
+            if not self.n:
+                return 0
+            self._fill()
+        k = min(len(b), self.e - self.p)
+        b[:k] = self.m[self.p:self.p + k]
+        self.p += k
+        return k
+    def read(self, n):
+        b = bytearray(n)
+        return bytes(b[:self.readinto(b)])
+    def drain(self):
+        while self.n:
+            self._fill()
+def _mpb_read(r, m):
+    i = 0
+    while i < len(m):
+        n = r.readinto(m[i:])
+        if not n:
+            raise EOFError
+        i += n
+def _mpb_unbundle(size, chunk, z, ready):
+    s = _mpb_In(size, chunk)
+    r = _mpb_dio(s) if z else s
+    h = memoryview(bytearray(6))
+    m = memoryview(bytearray(512))
+    failed = []
+    ready()
+    _mpb_read(r, h[:4])
+    for _ in range(unpack("<I", h[:4])[0]):
+        _mpb_read(r, h)
+        n, size = unpack("<HI", h)
+        p = bytearray(n)
+        _mpb_read(r, memoryview(p))
+        p = str(p, "utf-8")
+        t = p + ".mpbt"
+        try:
+            f = open(t, "wb")
+        except OSError:
+            f = None
+            failed.append(p)
+        while size:
+            k = min(size, 512)
+            _mpb_read(r, m[:k])
+            if f:
+                try:
+                    f.write(m[:k])
+                except OSError:
+                    f.close()
+                    f = None
+                    failed.append(p)
+            size -= k
+        if f:
+            f.close()
+            try:
+                os.rename(t, p)
+            except OSError:
+                failed.append(p)
+    s.drain()
+    return failed
+"""
+
+DELTA_FUNCS = """
+import os
+from hashlib import sha1
+from struct import pack, unpack
+from binascii import hexlify
+try:
+    from binascii import crc32 as _mpb_crc
+except ImportError:
+    _mpb_crc = None
+def _mpb_blocks(path, bs, emit):
+    b = bytearray(bs)
+    mv = memoryview(b)
+    with open(path, "rb") as f:
+        while n := f.readinto(b):
+            d = sha1(mv[:n]).digest()
+            emit(d + pack("<I", _mpb_crc(mv[:n])) if _mpb_crc else d)
+def _mpb_patch(path, delta, bs, expected):
+    tmp = path + ".mpbp"
+    mv = memoryview(bytearray(512))
+    h = sha1()
+    with open(path, "rb") as s:
+        with open(delta, "rb") as d:
+            with open(tmp, "wb") as o:
+                while r := d.read(9):
+                    k, a, n = unpack("<BII", r)
+                    if k == 67:
+                        s.seek(a * bs)
+                        f, n = s, n * bs
+                    else:
+                        f, n = d, a
+                    while n:
+                        c = f.readinto(mv[:min(n, 512)])
+                        if not c:
+                            break
+                        o.write(mv[:c])
+                        h.update(mv[:c])
+                        n -= c
+    os.remove(delta)
+    if hexlify(h.digest()).decode() != expected:
+        os.remove(tmp)
+        raise OSError("patch verification failed")
+    os.remove(path)
+    os.rename(tmp, path)
+"""
+
+# `emit` receives an empty string or the errno for each operation
+MUTATION_FUNCS = """
+import os
+from gc import collect
+def _mpb_batch(ops, emit):
+    for o, a, b in ops:
+        try:
+            if o == "m":
+                os.mkdir(a)
+            elif o == "r":
+                os.remove(a)
+            elif o == "d":
+                os.rmdir(a)
+            elif o == "n":
+                os.rename(a, b)
+            else:
+                m = memoryview(bytearray(512))
+                with open(a, "rb") as s, open(b + ".mpbt", "wb") as d:
+                    while n := s.readinto(m):
+                        d.write(m[:n])
+                os.rename(b + ".mpbt", b)
+            emit("")
+        except OSError as e:
+            emit(str(e.args[0]))
+def _mpb_clear(root, emit):
+    st = [root]
+    dirs = []
+    while st:
+        d = st.pop()
+        for e in list(os.ilistdir(d)):
+            p = d.rstrip("/") + "/" + e[0]
+            if e[1] == 0x4000:
+                st.append(p)
+                dirs.append(p)
+            else:
+                try:
+                    os.remove(p)
+                    emit("r" + p)
+                except OSError:
+                    emit("R" + p)
+        collect()
+    while dirs:
+        p = dirs.pop()
+        try:
+            os.rmdir(p)
+            emit("d" + p)
+        except OSError:
+            emit("D" + p)
 """
+# The agent and streaming transfers read and write raw bytes on stdin/stdout
+BUFFERED_STDIO_FUNC = """
+import sys
+print(int(hasattr(sys.stdin, "buffer") and hasattr(sys.stdout, "buffer")))
+"""
+BOARD_ID_FUNC = """
+try:
+    from machine import unique_id
+    from binascii import hexlify
+    print(hexlify(unique_id()).decode())
+except Exception:
+    pass
+"""
+
+MUTATION_OPS = {
+    "mkdir": "m",
+    "rm": "r",
+    "rmdir": "d",
+    "rename": "n",
+    "copy": "c",
+}
+
+DELTA_SUFFIX = ".mpbd"
+COMPRESSED_SUFFIX = ".mpbz"
+# Files are written under this suffix and renamed into place once complete,
+# so an interrupted transfer never leaves a truncated file behind
+TEMP_SUFFIX = ".mpbt"
+# Left on the board by interrupted transfers and removed on the next sync
+LEFTOVER_SUFFIXES = (TEMP_SUFFIX, COMPRESSED_SUFFIX, DELTA_SUFFIX, ".mpbp")
+# Files smaller than this are not worth the extra inflate round-trip
+COMPRESS_THRESHOLD = 512
+# Compressed payloads must be at least 10% smaller than the original
+COMPRESS_MIN_RATIO = 0.9
+
+# Seconds a board gets to answer Ctrl-A before it is assumed to be blocked by
+# a session that was cut off
+UNBLOCK_TIMEOUT = 1
+
+# Seconds of the coarsest board clock tick (FAT). An mtime is only recorded in
+# the hashtable once the board clock has moved past it, as a later write in the
+# same tick would leave it unchanged
+MTIME_GRANULARITY = 2
+# Upper bound for the size of path lists sent in a single hashing exec, so the
+# compiled script stays small enough for boards with little RAM
+HASH_BATCH_SIZE = 4096
+# Raw bytes per exec when appending, sent as an escaped bytes literal
+APPEND_CHUNK_SIZE = 1024
+MUTATION_BATCH_SIZE = 4096
+# Files are sent in bundles of about this many bytes, so a failure only costs
+# one bundle and the host never holds a whole project in memory
+BUNDLE_SIZE = 1024 * 1024
+BUNDLE_HEADER = "<HI"
+# Syncs with fewer changes are quick to redo and are not journaled
+JOURNAL_MIN_FILES = 8
+JOURNAL_MIN_BYTES = 64 * 1024
+# Seconds between progress updates of the journal on the board
+JOURNAL_FLUSH_INTERVAL = 5
+
+
+def encode_delta(src, blocks, remote_size) -> tuple[bytes, bytes]:
+    with open(src, "rb") as file:
+        data = file.read()
+    return data, DeltaBuilder(BLOCK_SIZE).build(data, blocks, remote_size)
+
+
+def progress_printer(prefix: str):
+    def print_prog(written, total):
+        utils.print_progress_bar(
+            iteration=written,
+            total=total,
+            decimals=0,
+            prefix=prefix.ljust(60),
+            suffix="Complete",
+            length=15,
+        )
+
+    return print_prog
+
+
+def parse_listing_line(line: bytes) -> tuple[bool, int, int, str]:
+    kind, size, mtime, path = line.decode("utf-8").split(" ", 3)
+    if "\\" in path:
+        path = re.sub(
+            r"\\(.)", lambda m: {"n": "\n", "r": "\r"}.get(m[1], m[1]), path
+        )
+    return kind == "F", int(size), int(mtime), path
+
+
+def generate_line_consumer(line_callback):
+    pending = bytearray()
+
+    def line_consumer(b):
+        pending.extend(b.replace(b"\x04", b""))
+        if b"\n" in b:
+            *lines, rest = pending.split(b"\n")
+            pending[:] = rest
+            for line in lines:
+                line_callback(line.rstrip(b"\r"))
+
+    return line_consumer
 
 
 def generate_buffer():
@@ -53,57 +542,611 @@ def generate_buffer():
 
 
 class ExtendedSerialTransport(SerialTransport):
-    def fs_recursive_listdir(self):
-        buf, consumer = generate_buffer()
-        self.exec(RECURSIVE_LS, data_consumer=consumer)
-        dirs = {}
-        files = {}
-        for item in eval(f'[{buf.decode("utf-8")}]'):
-            if item[1]:
-                files[item[0]] = item[2]
+    def __init__(
+        self,
+        *args,
+        use_agent: bool = False,
+        compress: bool = False,
+        compress_threshold: int = COMPRESS_THRESHOLD,
+        delta: bool = False,
+        transfer_profile: Optional[TransferProfile] = None,
+        checksum: str = "auto",
+        bundle: bool = False,
+        profiler: Optional[Profiler] = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.agent = DeviceAgent(self) if use_agent else None
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        # (can inflate, can deflate) on the board, probed once per session
+        self.remote_compression = (False, False)
+        self.delta = delta
+        # Measured on entering the raw REPL when no profile is pinned
+        self.transfer_profile = transfer_profile
+        self.profile = transfer_profile or TRANSFER_PROFILES["legacy"]
+        # "auto" or one of CHECKSUMS, negotiated with the board once per
+        # connection into `checksum`
+        self.requested_checksum = checksum
+        self.checksum: Optional[str] = None
+        # Upload the files of a sync in bundles instead of one by one
+        self.bundle = bundle
+        # Counts round trips, traffic and time per phase when set
+        self.profiler = profiler
+        if profiler is not None:
+            self.serial = CountingSerial(self.serial, profiler)
+        # Listed lazily and dropped whenever code on the board may have changed
+        # it. Listing again is cheap, unchanged files are not hashed again as
+        # long as the hashtable knows their mtime
+        self.remote_tree: Optional[RemoteTree] = None
+        # Journal of the running sync, see _start_journal()
+        self._journal: Optional[Journal] = None
+        self._journal_flushed = 0.0
+        # Hex machine.unique_id(), None when the port does not provide one
+        self.board_id: Optional[str] = None
+        # Latest time.time() read from the board, 0 when it has none
+        self.board_clock = 0
+
+    @property
+    def agent_active(self) -> bool:
+        return self.agent is not None and self.agent.active
+
+    def phase(self, name: str, path: Optional[str] = None):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name, path)
+
+    def exec_raw_no_follow(self, command):
+        if self.profiler is not None:
+            self.profiler.execs += 1
+        super().exec_raw_no_follow(command)
+
+    def fs_list_tree(self, root="/") -> RemoteTree:
+        if self.agent_active:
+            return RemoteTree(*self.agent.listdir(root))
+        tree = RemoteTree()
+        consumer = generate_line_consumer(
+            lambda line: tree.add_entry(*parse_listing_line(line))
+        )
+        if not self.profile.streaming:
+            self.exec(LS_FUNCS + f"_mpb_ls({root!r}, _mpb_print)", data_consumer=consumer)
+            return tree
+        self.exec_raw_no_follow(LS_FUNCS + f"_mpb_ls({root!r}, _mpb_frame)")
+        while True:
+            self._expect_stream_ack()
+            size = struct.unpack("<I", read_exact(self.serial, 4))[0]
+            if not size:
+                break
+            consumer(read_exact(self.serial, size))
+        self._follow_stream()
+        return tree
+
+    def get_remote_tree(self) -> RemoteTree:
+        if self.remote_tree is None:
+            with self.phase("device listing"):
+                self.remote_tree = self.fs_list_tree()
+        return self.remote_tree
+
+    def fs_get(self, src, dest, chunk_size=None, progress_callback=None, size=None):
+        # `size` is the size of `src` on the board when it is known, smaller
+        # files are not worth the deflate round-trip
+        if (
+            self.compress
+            and self.remote_compression[1]
+            and (size is None or size >= self.compress_threshold)
+        ):
+            data = self._get_compressed(src, chunk_size, progress_callback)
+            if data is not None:
+                with open(dest, "wb") as file:
+                    file.write(data)
+                return
+        with open(dest, "wb") as file:
+            self._get_fileobj(src, file, chunk_size, progress_callback)
+
+    def fs_put(
+        self,
+        src,
+        dest,
+        chunk_size=None,
+        progress_callback=None,
+        payload: Optional[Payload] = None,
+    ):
+        # A payload prepared by pack_file() saves reading the file again
+        size = os.path.getsize(src) if payload is None else payload.size
+        if payload is None and self._should_compress(size):
+            with open(src, "rb") as file:
+                payload = self._pack(file.read())
+        if payload is not None:
+            self._put_payload(payload, dest, chunk_size, progress_callback)
+        else:
+            with open(src, "rb") as file:
+                self._put_fileobj(file, size, dest, chunk_size, progress_callback)
+        if self.remote_tree is not None:
+            self.remote_tree.add_file(dest, size)
+
+    def pack_file(self, src) -> Optional[Payload]:
+        # Safe to run on a worker thread, returns None for files that are
+        # better streamed from disk
+        if os.path.getsize(src) > MAX_PREPARED_FILE:
+            return None
+        with open(src, "rb") as file:
+            return self._pack(file.read())
+
+    def pack_bundle(self, files) -> tuple[Payload, dict[str, int]]:
+        # Safe to run on a worker thread. Returns the stream for (src, dest)
+        # pairs and the size of each destination
+        data = bytearray(struct.pack("<I", len(files)))
+        sizes = {}
+        for src, dest in files:
+            with open(src, "rb") as file:
+                content = file.read()
+            path = dest.encode("utf-8")
+            data += struct.pack(BUNDLE_HEADER, len(path), len(content)) + path
+            data += content
+            sizes[dest] = len(content)
+        return self._pack(bytes(data)), sizes
+
+    def fs_put_bundle(self, files, progress_callback=None, packed=None) -> list[str]:
+        # Uploads (src, dest) pairs as one stream and returns the destinations
+        # the board could not write
+        payload, sizes = packed or self.pack_bundle(files)
+        data, compressed = payload.data, payload.compressed
+        chunk_size = self.profile.chunk_size
+        if self.agent_active:
+            failed = self.agent.unbundle(
+                io.BytesIO(data),
+                len(data),
+                compressed,
+                chunk_size=chunk_size,
+                window=self.profile.window,
+                progress_callback=progress_callback,
+            )
+        else:
+            self.exec_raw_no_follow(
+                "kbd_intr(-1)\n"
+                "try:\n"
+                f" for p in _mpb_unbundle({len(data)}, {chunk_size}, {compressed},"
+                " lambda: sys.stdout.buffer.write(b'\\x06')):\n"
+                "  print(p)\n"
+                "finally:\n"
+                " kbd_intr(3)"
+            )
+            self._expect_stream_ack()
+            self._send_stream(
+                io.BytesIO(data), len(data), chunk_size, progress_callback
+            )
+            out, err = self.follow(timeout=10)
+            if err:
+                raise TransportError("exception", out, err)
+            failed = out.decode("utf-8").splitlines()
+        if self.remote_tree is not None:
+            for dest, size in sizes.items():
+                if dest not in failed:
+                    self.remote_tree.add_file(dest, size)
+        return failed
+
+    def fs_readfile(self, src, chunk_size=None):
+        file = io.BytesIO()
+        self._get_fileobj(src, file, chunk_size)
+        return file.getvalue()
+
+    def fs_writefile(self, dest, data, chunk_size=None):
+        self._put_bytes(data, dest, chunk_size)
+        if self.remote_tree is not None:
+            self.remote_tree.add_file(dest, len(data))
+
+    def fs_append(self, dest, data):
+        if self.agent_active:
+            self.agent.append(dest, data)
+        else:
+            for i in range(0, len(data), APPEND_CHUNK_SIZE):
+                self.exec(
+                    f"with open({dest!r}, 'ab') as f: "
+                    f"f.write({bytes(data[i : i + APPEND_CHUNK_SIZE])!r})"
+                )
+        if self.remote_tree is not None:
+            self.remote_tree.append_file(dest, len(data))
+
+    def fs_rename(self, src, dest):
+        if self.agent_active:
+            self.agent.rename(src, dest)
+        else:
+            buf, consumer = generate_buffer()
+            self.exec(
+                f"from os import rename; rename({src!r}, {dest!r})",
+                data_consumer=consumer,
+            )
+        self._track_mutation("rename", src, dest)
+
+    def fs_mkdir(self, dir):
+        if self.agent_active:
+            self.agent.mkdir(dir)
+        else:
+            super().fs_mkdir(dir)
+        self._track_mutation("mkdir", dir)
+
+    def fs_rmdir(self, dir):
+        if self.agent_active:
+            self.agent.rmdir(dir)
+        else:
+            super().fs_rmdir(dir)
+        self._track_mutation("rmdir", dir)
+
+    def fs_rm(self, src):
+        if self.agent_active:
+            self.agent.rm(src)
+        else:
+            super().fs_rm(src)
+        self._track_mutation("rm", src)
+
+    def fs_batch(self, ops) -> list:
+        # Runs (op, path, dest) tuples with one round-trip per batch and returns
+        # None or the error name for each of them, in order
+        codes = [(MUTATION_OPS[op], path, dest) for op, path, dest in ops]
+        if self.agent_active:
+            errors = self.agent.batch(codes)
+        else:
+            errors = []
+            items = list(map(repr, codes))
+            for batch in utils.batched_by_size(items, MUTATION_BATCH_SIZE):
+                buf, consumer = generate_buffer()
+                self.exec(
+                    f"_mpb_batch([{','.join(batch)}], print)", data_consumer=consumer
+                )
+                errors.extend(buf.decode("utf-8").splitlines())
+        results = []
+        for (op, path, dest), error in zip(ops, errors):
+            if error:
+                results.append(errno.errorcode.get(int(error), error))
             else:
-                dirs[item[0]] = item[2]
-        return dirs, files
-
-    def fs_verbose_get(self, src, dest, chunk_size=1024, dry: bool = False):
-        def print_prog(written, total):
-            utils.print_progress_bar(
-                iteration=written,
-                total=total,
-                decimals=0,
-                prefix=f"{Fore.LIGHTCYAN_EX} ↓ Getting {src}".ljust(60),
-                suffix="Complete",
-                length=15,
+                self._track_mutation(op, path, dest)
+                results.append(None)
+        return results
+
+    def _track_mutation(self, op, path, dest=None):
+        if self.remote_tree is None:
+            return
+        if op == "mkdir":
+            self.remote_tree.add_dir(path)
+        elif op == "rm":
+            self.remote_tree.remove_file(path)
+        elif op == "rmdir":
+            self.remote_tree.remove_dir(path)
+        elif op == "rename":
+            self.remote_tree.rename(path, dest)
+        elif op == "copy":
+            self.remote_tree.copy_file(path, dest)
+
+    def _get_fileobj(self, src, file, chunk_size=None, progress_callback=None):
+        chunk_size = chunk_size or self.profile.chunk_size
+        if self.agent_active:
+            return self.agent.get(src, file, progress_callback=progress_callback)
+        if not self.profile.streaming:
+            return self._get_fileobj_legacy(src, file, chunk_size, progress_callback)
+        self.exec_raw_no_follow(f"_mpb_send({src!r}, {chunk_size})")
+        self._expect_stream_ack()
+        size = struct.unpack("<I", read_exact(self.serial, 4))[0]
+        written = 0
+        while written < size:
+            data = read_exact(self.serial, min(chunk_size, size - written))
+            file.write(data)
+            written += len(data)
+            if progress_callback:
+                progress_callback(written, size)
+        self._follow_stream()
+
+    def _put_fileobj(self, file, size, dest, chunk_size=None, progress_callback=None):
+        chunk_size = chunk_size or self.profile.chunk_size
+        if self.agent_active:
+            return self.agent.put(
+                file,
+                size,
+                dest,
+                chunk_size=chunk_size,
+                window=self.profile.window,
+                progress_callback=progress_callback,
+            )
+        if not self.profile.streaming:
+            return self._put_fileobj_legacy(
+                file, size, dest, chunk_size, progress_callback
             )
+        self.exec_raw_no_follow(f"_mpb_recv({dest!r}, {size}, {chunk_size})")
+        self._expect_stream_ack()
+        self._send_stream(file, size, chunk_size, progress_callback)
+        self._follow_stream()
+
+    def _get_fileobj_legacy(self, src, file, chunk_size, progress_callback=None):
+        if progress_callback:
+            src_size = self.fs_stat(src).st_size
+            written = 0
+        self.exec(f"f=open({src!r},'rb')\nr=f.read")
+        while True:
+            buf, consumer = generate_buffer()
+            self.exec(f"print(r({chunk_size}))", data_consumer=consumer)
+            data = ast.literal_eval(buf.decode("ascii"))
+            if not data:
+                break
+            file.write(data)
+            if progress_callback:
+                written += len(data)
+                progress_callback(written, src_size)
+        self.exec("f.close()")
+
+    def _put_fileobj_legacy(self, file, size, dest, chunk_size, progress_callback=None):
+        written = 0
+        temp = dest + TEMP_SUFFIX
+        self.exec(f"f=open({temp!r},'wb')\nw=f.write")
+        while data := file.read(chunk_size):
+            self.exec(f"w({data!r})")
+            written += len(data)
+            if progress_callback:
+                progress_callback(written, size)
+        self.exec(f"f.close()\nfrom os import rename\nrename({temp!r},{dest!r})")
+
+    def _expect_stream_ack(self):
+        response = self.serial.read(1)
+        if response != ACK:
+            self._raise_stream_error()
+
+    def _send_stream(self, file, size, chunk_size, progress_callback=None):
+        try:
+            send_windowed(
+                self.serial,
+                file,
+                size,
+                chunk_size,
+                self.profile.window,
+                progress_callback,
+            )
+        except TransportError as e:
+            if e.args[1:] == (b"\x04",):
+                self._raise_stream_error()
+            raise
+        except TransferInterrupted as e:
+            # The receiver has failed or finished, so the board is back at the
+            # raw REPL once its output is read
+            with suppress(TransportError):
+                self._follow_stream()
+            raise e.reason from None
+
+    def _raise_stream_error(self):
+        # The receiver loop failed, so the first EOF has just been read and
+        # the traceback follows up to the second one
+        err = self.read_until(1, b"\x04", timeout=10)
+        raise TransportError("exception", b"", err[:-1])
+
+    def _follow_stream(self):
+        data, err = self.follow(timeout=10)
+        if err:
+            raise TransportError("exception", data, err)
+
+    def _calibrate(self) -> TransferProfile:
+        try:
+            start = time.monotonic()
+            mem_free, buffered = map(int, self.exec(CALIBRATE_FUNCS).split())
+            round_trip = time.monotonic() - start
+            if not buffered:
+                # Streaming reads and writes raw bytes on stdin and stdout
+                print(Fore.LIGHTBLACK_EX, "! Board has no sys.stdin.buffer")
+                utils.reset_term_color()
+                return TRANSFER_PROFILES["legacy"]
+            start = time.monotonic()
+            self.exec(f"_mpb_o.write(bytes({CALIBRATE_SIZE}))")
+            elapsed = max(time.monotonic() - start - round_trip, 1e-3)
+        except (TransportError, ValueError):
+            print(Fore.LIGHTBLACK_EX, "! Could not measure the link")
+            utils.reset_term_color()
+            return TRANSFER_PROFILES["legacy"]
+        return auto_profile(mem_free, round_trip, CALIBRATE_SIZE / elapsed)
+
+    def _put_bytes(self, data, dest, chunk_size=None, progress_callback=None):
+        self._put_payload(self._pack(data), dest, chunk_size, progress_callback)
+
+    def _pack(self, data: bytes) -> Payload:
+        if self._should_compress(len(data)):
+            compressed = utils.compress(data)
+            if len(compressed) < len(data) * COMPRESS_MIN_RATIO:
+                return Payload(compressed, True, len(data))
+        return Payload(data, False, len(data))
+
+    def _put_payload(
+        self, payload: Payload, dest, chunk_size=None, progress_callback=None
+    ):
+        if payload.compressed:
+            return self._put_compressed(
+                payload.data, dest, chunk_size, progress_callback
+            )
+        self._put_fileobj(
+            io.BytesIO(payload.data),
+            len(payload.data),
+            dest,
+            chunk_size,
+            progress_callback,
+        )
+
+    def _should_compress(self, size: int) -> bool:
+        return (
+            self.compress
+            and self.remote_compression[0]
+            and size >= self.compress_threshold
+        )
 
+    def _probe_compression(self):
+        buf, consumer = generate_buffer()
+        self.exec(COMPRESSION_FUNCS, data_consumer=consumer)
+        result = buf.decode("utf-8").strip()
+        self.remote_compression = ("d" in result, "c" in result)
+        if not self.remote_compression[0]:
+            print(Fore.LIGHTBLACK_EX, "! Board has no deflate/zlib module")
+            utils.reset_term_color()
+
+    def _remote_inflate(self, src, dest):
+        if self.agent_active:
+            return self.agent.inflate(src, dest)
+        self.exec(f"_mpb_inflate({src!r}, {dest!r})")
+
+    def _remote_deflate(self, src, dest, threshold) -> bool:
+        # False when the board skipped the file as too small or incompressible
+        if self.agent_active:
+            return self.agent.deflate(src, dest, threshold)
+        written = self.exec(f"print(_mpb_deflate({src!r}, {dest!r}, {threshold}))")
+        return bool(int(written))
+
+    def _put_compressed(self, data, dest, chunk_size=None, progress_callback=None):
+        tmp = dest + COMPRESSED_SUFFIX
+        self._put_fileobj(
+            io.BytesIO(data), len(data), tmp, chunk_size, progress_callback
+        )
+        self._remote_inflate(tmp, dest)
+
+    def _get_compressed(self, src, chunk_size=None, progress_callback=None):
+        tmp = src + COMPRESSED_SUFFIX
+        if not self._remote_deflate(src, tmp, self.compress_threshold):
+            return None
+        file = io.BytesIO()
+        self._get_fileobj(tmp, file, chunk_size, progress_callback)
+        self.fs_rm(tmp)
+        return utils.decompress(file.getvalue())
+
+    def _remote_blocks(self, path, block_size):
+        if self.agent_active:
+            return list(map(parse_block_signature, self.agent.blocks(path, block_size)))
+        buf, consumer = generate_buffer()
+        self.exec(
+            f"_mpb_blocks({path!r}, {block_size}, "
+            "lambda d: print(hexlify(d).decode()))",
+            data_consumer=consumer,
+        )
+        return [
+            parse_block_signature(bytes.fromhex(line))
+            for line in buf.decode("utf-8").split()
+        ]
+
+    def _remote_patch(self, path, delta_path, block_size, expected_sha1):
+        if self.agent_active:
+            return self.agent.patch(path, delta_path, block_size, expected_sha1)
+        self.exec(
+            f"_mpb_patch({path!r}, {delta_path!r}, {block_size}, {expected_sha1!r})"
+        )
+
+    def _progress_printer(self, prefix: str):
+        print_prog = progress_printer(prefix)
+        if self.profiler is None:
+            return print_prog
+
+        def profiled(written, total):
+            with self.profiler.phase("progress output"):
+                print_prog(written, total)
+
+        return profiled
+
+    def fs_verbose_get(self, src, dest, chunk_size=None, dry: bool = False, size=None):
+        print_prog = self._progress_printer(f"{Fore.LIGHTCYAN_EX} ↓ Getting {src}")
         if not dry:
-            self.fs_get(src, dest, chunk_size=chunk_size, progress_callback=print_prog)
+            with self.phase("downloads", src):
+                self.fs_get(
+                    src,
+                    dest,
+                    chunk_size=chunk_size,
+                    progress_callback=print_prog,
+                    size=size,
+                )
+        print_prog(1, 1)
+        utils.reset_term_color(new_line=True)
+
+    def fs_verbose_put(
+        self,
+        src,
+        dest,
+        chunk_size=None,
+        dry: bool = False,
+        payload: Optional[Payload] = None,
+    ):
+        print_prog = self._progress_printer(f"{Fore.LIGHTYELLOW_EX} ↑ Putting {dest}")
+        if not dry:
+            with self.phase("uploads", dest):
+                self.fs_put(
+                    src,
+                    dest,
+                    chunk_size=chunk_size,
+                    progress_callback=print_prog,
+                    payload=payload,
+                )
         print_prog(1, 1)
         utils.reset_term_color(new_line=True)
 
-    def fs_verbose_put(self, src, dest, chunk_size=1024, dry: bool = False):
-        def print_prog(written, total):
-            utils.print_progress_bar(
-                iteration=written,
-                total=total,
-                decimals=0,
-                prefix=f"{Fore.LIGHTYELLOW_EX} ↑ Putting {dest}".ljust(60),
-                suffix="Complete",
-                length=15,
+    def fs_verbose_put_bundle(self, files, executor=None) -> list[str]:
+        # With an executor, the next bundles are packed while one is sent
+        failed = []
+        batches = utils.batched_by_size(
+            files, BUNDLE_SIZE, size_of=lambda item: os.path.getsize(item[0])
+        )
+        if executor is None:
+            batches = ((batch, None) for batch in batches)
+        else:
+            batches = prefetch(
+                executor,
+                list(batches),
+                self.pack_bundle,
+                size_of=lambda batch: sum(os.path.getsize(src) for src, _ in batch),
             )
+        for batch, packed in batches:
+            label = f"{len(batch)} files in a bundle"
+            print_prog = self._progress_printer(
+                f"{Fore.LIGHTYELLOW_EX} ↑ Putting {label}"
+            )
+            if packed is not None:
+                packed = self._wait_for_host(packed)
+            with self.phase("uploads", label):
+                failed.extend(
+                    self.fs_put_bundle(
+                        batch, progress_callback=print_prog, packed=packed
+                    )
+                )
+            print_prog(1, 1)
+            utils.reset_term_color(new_line=True)
+        for dest in failed:
+            print(Fore.RED, "E Cannot write", dest)
+            utils.reset_term_color()
+        return failed
 
-        if not dry:
-            self.fs_put(src, dest, chunk_size=chunk_size, progress_callback=print_prog)
+    def start_delta(self, executor, src, dest, remote_size) -> Future:
+        # Block signatures are fetched over the link, the delta is encoded on
+        # the executor. Resolves to (file content, delta)
+        with self.phase("delta signatures"):
+            blocks = self._remote_blocks(dest, BLOCK_SIZE)
+        return executor.submit(encode_delta, src, blocks, remote_size)
+
+    def fs_verbose_patch(self, dest, data, delta, chunk_size=None) -> bool:
+        # Returns False when a delta is not worth it or could not be applied,
+        # so the caller falls back to a full upload
+        if len(delta) > len(data) * DELTA_MAX_RATIO:
+            return False
+        print_prog = self._progress_printer(
+            f"{Fore.LIGHTYELLOW_EX} Δ Patching {dest} "
+            f"({len(delta) * 100 // max(len(data), 1)}%)"
+        )
+        try:
+            with self.phase("uploads", dest):
+                self._put_bytes(delta, dest + DELTA_SUFFIX, chunk_size, print_prog)
+                self._remote_patch(
+                    dest,
+                    dest + DELTA_SUFFIX,
+                    BLOCK_SIZE,
+                    hashlib.sha1(data).hexdigest(),
+                )
+        except TransportError:
+            utils.reset_term_color(new_line=True)
+            return False
+        if self.remote_tree is not None:
+            self.remote_tree.add_file(dest, len(data))
         print_prog(1, 1)
         utils.reset_term_color(new_line=True)
+        return True
 
     def fs_verbose_rename(self, src, dest, dry: bool = False):
         if not dry:
-            buf, consumer = generate_buffer()
-            self.exec(
-                f'from os import rename; rename("{src}", "{dest}")',
-                data_consumer=consumer,
-            )
+            self.fs_rename(src, dest)
         print(Fore.LIGHTBLUE_EX, "O Rename", src, "→", dest)
         utils.reset_term_color()
 
@@ -119,28 +1162,105 @@ class ExtendedSerialTransport(SerialTransport):
         print(Fore.LIGHTRED_EX, "✕ Removed", src)
         utils.reset_term_color()
 
+    def fs_verbose_batch(self, ops, dry: bool = False) -> list:
+        with self.phase("file operations"):
+            results = [None] * len(ops) if dry else self.fs_batch(ops)
+        for (op, path, dest), error in zip(ops, results):
+            if error is None:
+                if op == "mkdir":
+                    print(Fore.LIGHTGREEN_EX, "* Created", path)
+                elif op == "rename":
+                    print(Fore.LIGHTBLUE_EX, "O Rename", path, "→", dest)
+                elif op == "copy":
+                    print(Fore.LIGHTBLUE_EX, "C Copy", path, "→", dest)
+                else:
+                    print(Fore.LIGHTRED_EX, "✕ Removed", path)
+            elif op == "rmdir":
+                self._print_rmdir_error(path)
+            else:
+                verb = {"mkdir": "create", "rm": "remove"}.get(op, op)
+                print(Fore.RED, f"E Cannot {verb}", path, f"({error})")
+            utils.reset_term_color()
+        return results
+
     def fs_verbose_rmdir(self, dir_path, dry: bool = False):
         try:
             if not dry:
                 self.fs_rmdir(dir_path)
         except TransportError:
-            print(
-                Fore.RED,
-                "E Cannot remove directory",
-                dir_path,
-                "as it might be mounted",
-            )
+            self._print_rmdir_error(dir_path)
         else:
             print(Fore.LIGHTRED_EX, "✕ Removed", dir_path)
         utils.reset_term_color()
 
-    def copy_all(self, dest_dir_path):
-        rdirs, rfiles = self.fs_recursive_listdir()
-        for rdir in rdirs:
-            os.makedirs(dest_dir_path + rdir, exist_ok=True)
+    @staticmethod
+    def _print_rmdir_error(dir_path):
+        print(
+            Fore.RED,
+            "E Cannot remove directory",
+            dir_path,
+            "as it might be mounted",
+        )
+
+    def mirror_to_dir(self, dir_path):
+        # Brings a mirror from an earlier session up to date, fetching only files
+        # whose size or content differs from the board
+        print(Fore.YELLOW, "- Updating local mirror")
+        utils.reset_term_color()
+        dir_path = utils.replace_backslashes(dir_path).rstrip("/")
+        remote_tree = self.get_remote_tree()
+        # mpbridge's own files on the board are not mirrored
+        rfiles = {
+            rfile: rsize
+            for rfile, rsize in remote_tree.files.items()
+            if not rfile.endswith(RESERVED_SUFFIXES)
+        }
+        ldirs, lfiles = utils.recursive_list_dir(dir_path)
+        for lfile_rel, lfile_abs in lfiles.items():
+            if lfile_rel not in rfiles:
+                os.remove(lfile_abs)
+        for ldir in sorted(ldirs, reverse=True):
+            if ldir not in remote_tree.dirs:
+                shutil.rmtree(ldirs[ldir], ignore_errors=True)
+        for rdir in remote_tree.dirs:
+            os.makedirs(dir_path + rdir, exist_ok=True)
+        same_size = [
+            rfile
+            for rfile, rsize in rfiles.items()
+            if rfile in lfiles and os.path.getsize(lfiles[rfile]) == rsize
+        ]
+        # Files the hashtable knows with their current mtime are not hashed
+        with self.phase("hashtable"):
+            hashtable = self._get_hash_table()
+            rdigests = self._stored_digests(same_size)
+        rdigests.update(remote_tree.digests)
+        rdigests.update(
+            self.get_digests([rfile for rfile in same_size if rfile not in rdigests])
+        )
+        remote_tree.digests.update(rdigests)
+        local_hashes = HashCache.for_dir(dir_path, self.checksum)
+        unchanged = 0
         for rfile in rfiles:
-            self.fs_verbose_get(rfile, dest_dir_path + rfile, chunk_size=256)
-        print(Fore.LIGHTGREEN_EX, "✓ Copied all files successfully")
+            rdigest = rdigests.get(rfile)
+            if rdigest is not None:
+                with self.phase("local hashing"):
+                    ldigest = local_hashes.get_digest(lfiles[rfile])
+                if rdigest == ldigest:
+                    unchanged += 1
+                    continue
+            self.fs_verbose_get(rfile, dir_path + rfile, size=rfiles[rfile])
+            with self.phase("local hashing"):
+                remote_tree.digests[rfile] = local_hashes.get_digest(
+                    dir_path + rfile
+                )
+        local_hashes.save()
+        # So the next session finds the files unchanged without hashing them
+        with self.phase("hashtable"):
+            self._write_hash_table(hashtable)
+        print(
+            Fore.LIGHTGREEN_EX,
+            f"✓ Mirror is up to date, {unchanged} unchanged files skipped",
+        )
         utils.reset_term_color()
 
     def sync_with_dir(
@@ -149,118 +1269,543 @@ class ExtendedSerialTransport(SerialTransport):
         dry: bool = False,
         push: bool = False,
         use_hashtable: bool = False,
+        tree: Optional[LocalTree] = None,
     ):
         print(Fore.YELLOW, "- Syncing")
-        hashtable = self._get_hash_table() if use_hashtable else {}
-        self.exec_raw_no_follow(SHA1_FUNC)
+        self._journal = None
         dir_path = utils.replace_backslashes(dir_path)
-        rdirs, rfiles = self.fs_recursive_listdir()
-        ldirs, lfiles = utils.recursive_list_dir(dir_path)
-        ignore = IgnoreStorage(dir_path=dir_path)
+        if tree is None:
+            with self.phase("local scan"):
+                tree = LocalTree(dir_path)
+        ldirs, lfiles = tree.dirs, tree.files
+        # Hashed on the host while the board is listed and hashed
+        tree.start_hashing(self.checksum)
+        remote_tree = self.get_remote_tree()
+        rdirs, rfiles = tree.ignore.prune(remote_tree.dirs, remote_tree.files)
         if (not dry) and (not push):
             for rdir in rdirs.keys():
-                if rdir not in ldirs and not ignore.match_dir(rdir):
+                if rdir not in ldirs:
                     os.makedirs(dir_path + rdir, exist_ok=True)
-        for ldir in ldirs.keys():
-            if ldir not in rdirs and not ignore.match_dir(ldir):
-                self.fs_verbose_mkdir(ldir, dry=dry)
-        for lfile_rel, lfiles_abs in lfiles.items():
-            if ignore.match_file(lfile_rel):
+        leftovers = [
+            rfile for rfile in remote_tree.files if rfile.endswith(LEFTOVER_SUFFIXES)
+        ]
+        self.fs_verbose_batch(
+            [("mkdir", ldir, None) for ldir in ldirs.keys() if ldir not in rdirs]
+            + [("rm", rfile, None) for rfile in leftovers],
+            dry=dry,
+        )
+        with self.phase("local hashing"):
+            ldigests = tree.get_digests(self.checksum)
+        state = local_state(
+            {lfile_rel: tree.stats[lfile_rel].st_size for lfile_rel in ldigests},
+            ldigests,
+        )
+        pending = self._resume_journal(state)
+        same_size = [
+            lfile_rel
+            for lfile_rel, lstat in tree.stats.items()
+            if rfiles.get(lfile_rel, None) == lstat.st_size
+        ]
+        # The hashtable is kept up to date on every sync. Its entries are
+        # trusted while the board reports the mtime they were recorded with,
+        # and by size alone when asked to. Digests learned earlier in this
+        # session are more recent than the hashtable stored on the board
+        with self.phase("hashtable"):
+            hashtable = self._get_hash_table()
+            rdigests = self._stored_digests(same_size)
+            unverified = {}
+            if use_hashtable:
+                unverified = self._stored_digests(same_size, by_size=True)
+        if pending is not None:
+            # Files left out of the journal were in sync when it was written,
+            # the others are uploaded again without hashing them
+            for rfile in same_size:
+                if rfile not in pending:
+                    rdigests[rfile] = ldigests[rfile]
+        rdigests.update(remote_tree.digests)
+        rdigests.update(
+            self.get_digests(
+                [
+                    rfile
+                    for rfile in same_size
+                    if rfile not in rdigests
+                    and rfile not in unverified
+                    and rfile not in (pending or ())
+                ]
+            )
+        )
+        # Unverified digests are not recorded again with a newer mtime
+        remote_tree.digests.update(rdigests)
+        for rfile, digest in unverified.items():
+            rdigests.setdefault(rfile, digest)
+        same_size = set(same_size)
+        # Remote files that keep their content, by size and digest, so that
+        # duplicates are copied on the board instead of being uploaded
+        sources = {
+            (rfiles[rfile], digest): rfile
+            for rfile, digest in rdigests.items()
+            if rfile in rfiles and ldigests.get(rfile, digest) == digest
+        }
+        copies = []
+        patches = []
+        uploads = []
+        planned = []
+        for lfile_rel, ldigest in ldigests.items():
+            if lfile_rel in same_size and rdigests.get(lfile_rel) == ldigest:
                 continue
-            if rfiles.get(lfile_rel, None) == os.path.getsize(lfiles_abs):
-                if lfile_rel in hashtable:
-                    sha1 = hashtable[lfile_rel]
+            planned.append(lfile_rel)
+            source = sources.get((tree.stats[lfile_rel].st_size, ldigest))
+            if source is not None:
+                copies.append(("copy", source, lfile_rel))
+            elif self.delta and not dry and rfiles.get(lfile_rel, 0) >= DELTA_MIN_SIZE:
+                patches.append((lfiles[lfile_rel], lfile_rel))
+            else:
+                uploads.append((lfiles[lfile_rel], lfile_rel))
+        changed = len(planned)
+        if not dry and (
+            len(planned) >= JOURNAL_MIN_FILES
+            or sum(tree.stats[p].st_size for p in planned) >= JOURNAL_MIN_BYTES
+        ):
+            self._start_journal(Journal(state, planned))
+        # The serial link is owned by this thread. Files are read, compressed
+        # and delta encoded on the workers ahead of the link
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            deltas = [
+                (src, dest, self.start_delta(executor, src, dest, rfiles[dest]))
+                for src, dest in patches
+            ]
+            self._upload_files(executor, uploads, dry=dry)
+            retries = []
+            for src, dest, future in deltas:
+                data, delta = self._wait_for_host(future)
+                if self.fs_verbose_patch(dest, data, delta):
+                    self._journal_finished([dest])
                 else:
-                    sha1 = self.get_sha1(lfile_rel)
-                    hashtable[lfile_rel] = sha1
-                if sha1 == utils.get_file_sha1(lfiles_abs):
-                    continue
-            hashtable[lfile_rel] = utils.get_file_sha1(lfiles_abs)
-            self.fs_verbose_put(lfiles_abs, lfile_rel, chunk_size=256, dry=dry)
+                    retries.append((src, dest))
+            self._upload_files(executor, retries, dry=dry)
+        if not dry:
+            for _, lfile_rel in uploads + patches:
+                remote_tree.digests[lfile_rel] = ldigests[lfile_rel]
+        if copies:
+            results = self.fs_verbose_batch(copies, dry=dry)
+            for (_, _, lfile_rel), error in zip(copies, results):
+                if error is not None:
+                    self.fs_verbose_put(lfiles[lfile_rel], lfile_rel, dry=dry)
+                    remote_tree.digests[lfile_rel] = ldigests[lfile_rel]
+                self._journal_finished([lfile_rel])
+        if not dry:
+            self._end_journal()
         if not push:
             for rfile, rsize in rfiles.items():
-                if ignore.match_file(rfile):
-                    continue
                 if rfile not in lfiles:
-                    self.fs_verbose_get(
-                        rfile, dir_path + rfile, chunk_size=256, dry=dry
-                    )
-        self._write_hash_table(hashtable)
+                    self.fs_verbose_get(rfile, dir_path + rfile, dry=dry, size=rsize)
+                    changed += 1
+        if not dry:
+            with self.phase("hashtable"):
+                self._write_hash_table(hashtable)
         print(Fore.LIGHTGREEN_EX, "✓ Files synced successfully")
+        return changed
 
-    def delete_absent_items(self, dir_path, dry: bool = False):
-        dir_path = utils.replace_backslashes(dir_path)
-        rdirs, rfiles = self.fs_recursive_listdir()
-        ldirs, lfiles = utils.recursive_list_dir(dir_path)
-        ignore = IgnoreStorage(dir_path=dir_path)
-        for rfile, rsize in rfiles.items():
-            if not ignore.match_file(rfile) and rfile not in lfiles:
-                self.fs_verbose_rm(rfile, dry=dry)
-        for rdir in rdirs.keys():
-            if not ignore.match_dir(rdir) and rdir not in ldirs:
-                # There might be ignored files in folders
-                with suppress(Exception):
-                    self.fs_verbose_rmdir(rdir, dry=dry)
+    def _upload_files(self, executor, files, dry: bool = False):
+        if not files:
+            return
+        if self.bundle and not dry and (self.agent_active or self.profile.streaming):
+            # Files the board could not write are retried one by one
+            failed = set(self.fs_verbose_put_bundle(files, executor))
+            self._journal_finished(dest for _, dest in files if dest not in failed)
+            files = [(src, dest) for src, dest in files if dest in failed]
+        if dry:
+            for src, dest in files:
+                self.fs_verbose_put(src, dest, dry=True)
+            return
+        for (src, dest), payload in prefetch(
+            executor,
+            files,
+            lambda item: self.pack_file(item[0]),
+            size_of=lambda item: min(os.path.getsize(item[0]), MAX_PREPARED_FILE),
+        ):
+            self.fs_verbose_put(src, dest, payload=self._wait_for_host(payload))
+            self._journal_finished([dest])
+
+    def _resume_journal(self, state: bytes) -> Optional[set[str]]:
+        # Returns the files an interrupted sync of the same local files did
+        # not get to, or None when there is nothing to resume
+        if JOURNAL_PATH not in self.get_remote_tree().files:
+            return None
+        journal = None
+        with self.phase("journal"):
+            with suppress(TransportError, OSError, ValueError, struct.error):
+                journal = Journal.parse(self.fs_readfile(JOURNAL_PATH))
+        if journal is None or journal.state != state:
+            print(
+                Fore.LIGHTBLACK_EX, "! Cannot resume the interrupted sync, starting over"
+            )
+            utils.reset_term_color()
+            return None
+        pending = journal.pending()
+        print(
+            Fore.YELLOW,
+            f"- Resuming interrupted sync, {len(pending)} of {len(journal.paths)} "
+            "files left",
+        )
+        utils.reset_term_color()
+        return set(pending)
+
+    def _start_journal(self, journal: Journal):
+        # Written before the board is changed and removed once the sync is
+        # done, so it only survives an interrupted sync
+        with self.phase("journal"):
+            self.fs_writefile(JOURNAL_PATH, journal.encode())
+        self._journal = journal
+        self._journal_flushed = time.monotonic()
+
+    def _journal_finished(self, paths):
+        if self._journal is None:
+            return
+        for path in paths:
+            self._journal.finish(path)
+        if time.monotonic() - self._journal_flushed < JOURNAL_FLUSH_INTERVAL:
+            return
+        progress = self._journal.take_progress()
+        if progress:
+            with self.phase("journal"):
+                self.fs_append(JOURNAL_PATH, progress)
+        self._journal_flushed = time.monotonic()
+
+    def _end_journal(self):
+        self._journal = None
+        if JOURNAL_PATH in self.get_remote_tree().files:
+            with self.phase("journal"):
+                self.fs_rm(JOURNAL_PATH)
+
+    def _wait_for_host(self, future: Future):
+        # Time the link sits idle because host work is behind
+        if future.done():
+            return future.result()
+        with self.phase("waiting for host"):
+            return future.result()
+
+    def delete_absent_items(
+        self, dir_path, dry: bool = False, tree: Optional[LocalTree] = None
+    ):
+        if tree is None:
+            with self.phase("local scan"):
+                tree = LocalTree(dir_path)
+        tree.start_hashing(self.checksum)
+        remote_tree = self.get_remote_tree()
+        rdirs, rfiles = tree.ignore.prune(remote_tree.dirs, remote_tree.files)
+        absent = [rfile for rfile in rfiles if rfile not in tree.files]
+        moves = self._plan_moves(tree, rdirs, rfiles, absent)
+        if moves:
+            # Parents of the new paths are created first
+            ops = [("mkdir", ldir, None) for ldir in tree.dirs if ldir not in rdirs]
+            results = self.fs_verbose_batch(ops + moves, dry=dry)
+            moved = {
+                path for (_, path, _), error in zip(moves, results[len(ops) :])
+                if error is None
+            }
+            absent = [rfile for rfile in absent if rfile not in moved]
+        ops = [("rm", rfile, None) for rfile in absent]
+        # Reverse order puts nested directories before their parents. Removing
+        # them may still fail as there might be ignored files in folders
+        ops.extend(
+            ("rmdir", rdir, None)
+            for rdir in sorted(rdirs, reverse=True)
+            if rdir not in tree.dirs
+        )
+        self.fs_verbose_batch(ops, dry=dry)
+
+    def _plan_moves(self, tree, rdirs, rfiles, absent) -> list:
+        # Absent remote files whose content shows up at a new local path are
+        # renamed there on the board instead of being uploaded again. Only
+        # files with a size some new local file has are hashed
+        new_files = [lfile for lfile in tree.files if lfile not in rfiles]
+        sizes = {tree.stats[lfile].st_size for lfile in new_files}
+        candidates = [rfile for rfile in absent if rfiles[rfile] in sizes]
+        if not candidates:
+            return []
+        remote_tree = self.get_remote_tree()
+        with self.phase("hashtable"):
+            remote_tree.digests.update(
+                self._stored_digests(
+                    [rfile for rfile in candidates if rfile not in remote_tree.digests]
+                )
+            )
+        remote_tree.digests.update(
+            self.get_digests(
+                [rfile for rfile in candidates if rfile not in remote_tree.digests]
+            )
+        )
+        sources = {}
+        for rfile in candidates:
+            digest = remote_tree.digests.get(rfile)
+            if digest is not None:
+                sources.setdefault((rfiles[rfile], digest), rfile)
+        with self.phase("local hashing"):
+            ldigests = tree.get_digests(self.checksum)
+        moves = []
+        for lfile in new_files:
+            rfile = sources.pop((tree.stats[lfile].st_size, ldigests[lfile]), None)
+            if rfile is not None:
+                moves.append(("rename", rfile, lfile))
+        return moves
 
     def clear_all(self):
         print(Fore.YELLOW, "- Deleting all files from MicroPython board")
-        rdirs, rfiles = self.fs_recursive_listdir()
-        for rfile in rfiles.keys():
-            self.fs_verbose_rm(rfile)
-        for rdir in rdirs.keys():
-            self.fs_verbose_rmdir(rdir)
+        with self.phase("clear"):
+            if self.agent_active:
+                self.agent.clear("/", self._report_cleared)
+            else:
+                self.exec(
+                    '_mpb_clear("/", print)',
+                    data_consumer=generate_line_consumer(
+                        lambda line: self._report_cleared(line.decode("utf-8"))
+                    ),
+                )
+        self.remote_tree = None
         print(Fore.LIGHTGREEN_EX, "✓ Deleted all files from MicroPython board")
 
+    def _report_cleared(self, line):
+        status, path = line[0], line[1:]
+        if status in "rd":
+            print(Fore.LIGHTRED_EX, "✕ Removed", path)
+        elif status == "D":
+            self._print_rmdir_error(path)
+        else:
+            print(Fore.RED, "E Cannot remove", path)
+        utils.reset_term_color()
+
     def enter_raw_repl_verbose(self, soft_reset=True):
         print(Fore.YELLOW, "- Entering raw repl")
         utils.reset_term_color()
-        return self.enter_raw_repl(soft_reset)
+        with self.phase("connect"):
+            self._start_session(soft_reset)
+
+    def _start_session(self, soft_reset):
+        self.enter_raw_repl(soft_reset)
+        if self.transfer_profile is None:
+            # Measured once per connection
+            self.profile = self.transfer_profile = self._calibrate()
+        print(Fore.YELLOW, "- Transfer profile:", self.profile.describe())
+        if self.checksum is None:
+            self.checksum = self._negotiate_checksum()
+        print(Fore.YELLOW, "- Checksum:", self.checksum)
+        utils.reset_term_color()
+        if self.profile.streaming:
+            self.exec(STREAM_FUNCS)
+        if self.compress:
+            self._probe_compression()
+        if self.delta:
+            self.exec(DELTA_FUNCS)
+        if self.bundle:
+            self.exec(BUNDLE_FUNCS)
+        clock, buffered, *board_id = self.exec(
+            HASHERS[self.checksum]
+            + DIGEST_FUNCS
+            + MUTATION_FUNCS
+            + "print_mtimes([])\n"
+            + BUFFERED_STDIO_FUNC
+            + BOARD_ID_FUNC
+        ).split()
+        self.board_clock = int(clock)
+        self.board_id = board_id[0].decode() if board_id else None
+        if self.agent is not None and not int(buffered):
+            print(
+                Fore.LIGHTBLACK_EX,
+                "! Board has no sys.stdin.buffer, not starting the agent",
+            )
+            utils.reset_term_color()
+        elif self.agent is not None:
+            print(Fore.YELLOW, "- Starting mpbridge agent")
+            utils.reset_term_color()
+            self.agent.start()
+
+    def _negotiate_checksum(self) -> str:
+        available = self.exec(CHECKSUM_PROBE).decode().split()
+        try:
+            checksum = choose_checksum(self.requested_checksum, available)
+        except ValueError as e:
+            raise TransportError(str(e))
+        if self.requested_checksum not in ("auto", checksum):
+            print(
+                Fore.LIGHTBLACK_EX,
+                f"! Board has no {self.requested_checksum}, using {checksum}",
+            )
+        if self.delta and "sha1" not in available:
+            # Block signatures and patch verification rely on SHA-1
+            print(Fore.LIGHTBLACK_EX, "! Board has no hashlib.sha1, delta disabled")
+            self.delta = False
+        return checksum
 
     def exit_raw_repl_verbose(self):
         print(Fore.YELLOW, "- Exiting raw repl")
         utils.reset_term_color()
         self.exit_raw_repl()
 
-    def get_sha1(self, file_path):
-        return eval(self.eval(f'get_sha1("{file_path}")').decode("utf-8"))
+    def enter_raw_repl(self, *args, **kwargs):
+        # Code running outside the raw REPL may have changed the filesystem
+        self.remote_tree = None
+        self._unblock()
+        super().enter_raw_repl(*args, **kwargs)
+
+    def _unblock(self):
+        # A session cut off during a transfer, or with the agent running,
+        # leaves the board reading stdin with Ctrl-C disabled. Zeros complete
+        # a pending chunk, abort the receive loop and make the agent quit
+        self.serial.write(b"\r\x03\x03\r\x01")
+        data = b""
+        deadline = time.monotonic() + UNBLOCK_TIMEOUT
+        while b"raw REPL; CTRL-B to exit\r\n>" not in data:
+            if time.monotonic() > deadline:
+                self.serial.write(bytes(MAX_CHUNK_SIZE + 1))
+                return
+            waiting = self.serial.inWaiting()
+            if waiting:
+                data += self.serial.read(waiting)
+            else:
+                time.sleep(0.01)
+
+    def exit_raw_repl(self):
+        if self.agent_active:
+            self.agent.stop()
+        self.remote_tree = None
+        super().exit_raw_repl()
+
+    def get_digests(self, file_paths) -> dict[str, bytes]:
+        with self.phase("device hashing"):
+            return self._get_digests(file_paths)
+
+    def _get_digests(self, file_paths) -> dict[str, bytes]:
+        if self.agent_active:
+            return self.agent.digests(file_paths)
+        digests = {}
+        for batch in utils.batched_by_size(file_paths, HASH_BATCH_SIZE):
+            buf, consumer = generate_buffer()
+            self.exec(f"print_digests({batch!r})", data_consumer=consumer)
+            for file_path, line in zip(batch, buf.decode("utf-8").splitlines()):
+                if line:
+                    digests[file_path] = bytes.fromhex(line)
+        return digests
+
+    def get_mtimes(self, file_paths) -> tuple[int, dict[str, int]]:
+        # Returns the board clock and the mtime of each file
+        if self.agent_active:
+            return self.agent.mtimes(file_paths)
+        clock = None
+        mtimes = {}
+        for batch in utils.batched_by_size(file_paths, HASH_BATCH_SIZE):
+            buf, consumer = generate_buffer()
+            self.exec(f"print_mtimes({batch!r})", data_consumer=consumer)
+            now, *lines = buf.decode("utf-8").splitlines()
+            clock = int(now) if clock is None else clock
+            for file_path, line in zip(batch, lines):
+                if line:
+                    mtimes[file_path] = int(line)
+        return clock or 0, mtimes
 
     def verbose_hard_reset(self):
+        if self.agent_active:
+            self.agent.stop()
         self.exec_raw_no_follow("from machine import reset; reset()")
         self.serial.close()
         print(Fore.LIGHTGREEN_EX, "✓ Hard reset board successfully")
         utils.reset_term_color()
 
+    def reopen(self, wait: int = 5):
+        # Native USB boards re-enumerate after a hard reset
+        for attempt in range(wait + 1):
+            try:
+                self.serial.open()
+                break
+            except OSError:
+                if attempt == wait:
+                    raise TransportError("failed to access " + self.device_name)
+                time.sleep(1)
+        self.in_raw_repl = False
+
     def verbose_soft_reset(self):
         self.serial.write(b"\x04")
         print(Fore.LIGHTGREEN_EX, "✓ Soft reset board successfully")
 
-    def _get_hash_table(self) -> dict:
-        with suppress(Exception):
-            return dict(
-                map(
-                    lambda t: (t[0].decode("utf-8"), t[1]),
-                    itertools.batched(
-                        unpack_length_prefixed(
-                            "B", self.fs_readfile("mpbridge.hashtable")
-                        ),
-                        2,
-                    ),
-                )
-            )
-        return {}
-
-    def _write_hash_table(self, hash_table: dict[str, bytes]):
-        # TODO Ignore update if not changed
-        self.fs_writefile(
-            "mpbridge.hashtable",
-            b"".join(
-                map(
-                    lambda i: len(i[0]).to_bytes(length=1, byteorder="big")
-                    + i[0].encode("utf-8")
-                    + len(i[1]).to_bytes(length=1, byteorder="big")
-                    + i[1],
-                    hash_table.items(),
-                )
-            ),
+    def _get_hash_table(self) -> HashTable:
+        remote_tree = self.get_remote_tree()
+        if remote_tree.hashtable is None:
+            remote_tree.hashtable = HashTable()
+            if HASHTABLE_PATH in remote_tree.files:
+                with suppress(TransportError, OSError, ValueError, struct.error):
+                    remote_tree.hashtable = HashTable.parse(
+                        self.fs_readfile(HASHTABLE_PATH)
+                    )
+        return remote_tree.hashtable
+
+    def _stored_digests(self, paths, by_size: bool = False) -> dict[str, bytes]:
+        # Hashtable digests of remote files that still have the size, and
+        # unless `by_size`, the mtime they were recorded with
+        remote_tree = self.get_remote_tree()
+        hashtable = self._get_hash_table()
+        usable = by_size or self._mtimes_usable()
+        digests = {}
+        for path in paths:
+            if not usable:
+                break
+            mtime = None if by_size else remote_tree.mtimes.get(path, 0)
+            digest = hashtable.get(path, remote_tree.files[path], self.checksum, mtime)
+            if digest is not None:
+                digests[path] = digest
+        return digests
+
+    def _mtimes_usable(self) -> bool:
+        # Filesystems without timestamps list every file at 0. Listed mtimes
+        # ahead of the board clock mean it was reset since, and mtimes may
+        # repeat
+        remote_tree = self.get_remote_tree()
+        listed = [
+            mtime
+            for path, mtime in remote_tree.mtimes.items()
+            if path in remote_tree.files
+        ]
+        return self.board_clock > 0 and (
+            not listed
+            or (any(listed) and max(listed) <= self.board_clock + MTIME_GRANULARITY)
         )
+
+    def _trusted_mtimes(self) -> dict[str, int]:
+        # Mtimes the board clock has moved past. Writing a file drops its
+        # listed mtime, so files written in this session are stat'ed again
+        if not self._mtimes_usable():
+            return {}
+        remote_tree = self.get_remote_tree()
+        written = [
+            rfile
+            for rfile in remote_tree.digests
+            if rfile in remote_tree.files and rfile not in remote_tree.mtimes
+        ]
+        if written:
+            clock, mtimes = self.get_mtimes(written)
+            self.board_clock = max(self.board_clock, clock)
+            remote_tree.mtimes.update(mtimes)
+        return {
+            rfile: mtime
+            for rfile, mtime in remote_tree.mtimes.items()
+            if 0 < mtime <= self.board_clock - MTIME_GRANULARITY
+        }
+
+    def _write_hash_table(self, hashtable: HashTable):
+        remote_tree = self.get_remote_tree()
+        mtimes = self._trusted_mtimes()
+        for rfile, rsize in remote_tree.files.items():
+            digest = remote_tree.digests.get(rfile)
+            if digest is not None:
+                hashtable.set(rfile, rsize, digest, self.checksum, mtimes.get(rfile, 0))
+        # Entries of removed files, or of files changed behind our back
+        for rfile, (_, size, _, _) in list(hashtable.entries.items()):
+            if rfile not in remote_tree.files or remote_tree.files[rfile] != size:
+                hashtable.discard(rfile)
+        if not hashtable.dirty:
+            return
+        append, data = hashtable.take_update()
+        if append:
+            self.fs_append(HASHTABLE_PATH, data)
+        else:
+            self.fs_writefile(HASHTABLE_PATH, data)
         print(Fore.LIGHTGREEN_EX, "✓ Updated hashtable")
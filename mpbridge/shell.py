@@ -5,10 +5,100 @@ import click
 import colorama
 
 from . import bridge
+from .checksum import CHECKSUMS
+from .serial_transport import COMPRESS_THRESHOLD
+from .transfer import TRANSFER_PROFILES, TransferProfile
 
 colorama.init()
 
 
+def _parse_transfer_profile(ctx, param, value: str) -> Optional[TransferProfile]:
+    try:
+        return TransferProfile.parse(value)
+    except ValueError:
+        raise click.BadParameter(
+            "expected auto, a profile name or CHUNK_SIZE[:WINDOW]"
+        )
+
+
+def _options(*options):
+    # Applies several click options in the order they are listed
+    def decorator(func):
+        for option in reversed(options):
+            func = option(func)
+        return func
+
+    return decorator
+
+
+_agent_option = click.option(
+    "--agent",
+    "use_agent",
+    is_flag=True,
+    default=False,
+    help="Use a resident helper on device to speedup file operations",
+)
+_transfer_options = _options(
+    click.option(
+        "--compress",
+        is_flag=True,
+        default=False,
+        help="Compress file transfers when the board supports deflate/zlib",
+    ),
+    click.option(
+        "--compress-threshold",
+        type=click.IntRange(min=0),
+        default=COMPRESS_THRESHOLD,
+        show_default=True,
+        help="Minimum file size in bytes to be transferred compressed",
+    ),
+    click.option(
+        "--transfer-profile",
+        default="auto",
+        show_default=True,
+        callback=_parse_transfer_profile,
+        help="Chunk size and pipelining of file transfers: auto, a board family "
+        f"({', '.join(TRANSFER_PROFILES)}) or CHUNK_SIZE[:WINDOW]",
+    ),
+    click.option(
+        "--checksum",
+        type=click.Choice(["auto", *CHECKSUMS], case_sensitive=False),
+        default="auto",
+        show_default=True,
+        help="Checksum used to detect changed files, auto picks the fastest one "
+        "the board supports",
+    ),
+)
+_sync_options = _options(
+    click.option(
+        "--delta",
+        is_flag=True,
+        default=False,
+        help="Upload only changed blocks of large modified files",
+    ),
+    click.option(
+        "--bundle",
+        is_flag=True,
+        default=False,
+        help="Upload changed files in bundles unpacked by the board in one go",
+    ),
+)
+_profile_options = _options(
+    click.option(
+        "--profile",
+        is_flag=True,
+        default=False,
+        help="Print round trips, traffic and time per phase at the end",
+    ),
+    click.option(
+        "--profile-json",
+        type=click.Path(dir_okay=False, writable=True),
+        default=None,
+        help="Also write the profile to a JSON file",
+    ),
+)
+
+
 @click.group()
 def main():
     pass
@@ -16,7 +106,19 @@ def main():
 
 @main.command("bridge", short_help="Start bridge mode")
 @click.argument("port")
-def bridge_mode(port: str):
+@_agent_option
+@_transfer_options
+@_profile_options
+def bridge_mode(
+    port: str,
+    use_agent: bool,
+    compress: bool,
+    compress_threshold: int,
+    transfer_profile: Optional[TransferProfile],
+    checksum: str,
+    profile: bool,
+    profile_json: Optional[str],
+):
     """Starts bridge mode on [PORT]
 
     [PORT] can be full path or :
@@ -28,7 +130,16 @@ def bridge_mode(port: str):
             c[n]  connect to serial port "COM[n]"
     """
 
-    bridge.start_bridge_mode(port=port)
+    bridge.start_bridge_mode(
+        port=port,
+        use_agent=use_agent,
+        compress=compress,
+        compress_threshold=compress_threshold,
+        transfer_profile=transfer_profile,
+        checksum=checksum,
+        profile=profile,
+        profile_json=profile_json,
+    )
 
 
 @main.command("sync", short_help="Sync files with a directory")
@@ -62,6 +173,10 @@ def bridge_mode(port: str):
     default=False,
     help="Use hashtable to speedup syncing process",
 )
+@_agent_option
+@_transfer_options
+@_sync_options
+@_profile_options
 def sync(
     port: str,
     dir_path: str,
@@ -69,6 +184,15 @@ def sync(
     dry_run: bool,
     push_only: bool,
     use_hashtable: bool,
+    use_agent: bool,
+    compress: bool,
+    compress_threshold: int,
+    delta: bool,
+    transfer_profile: Optional[TransferProfile],
+    checksum: str,
+    bundle: bool,
+    profile: bool,
+    profile_json: Optional[str],
 ):
     """Sync files of on [PORT] in specified directory [DIR_PATH]
 
@@ -82,6 +206,10 @@ def sync(
 
             c[n]  connect to serial port "COM[n]"
 
+            [vid]:[pid]  every connected board with this USB id
+
+    Several ports separated by commas are synced in parallel, push only.
+
     Sync files:
 
             Pull the files that are not in the local but exist in the device to the local.
@@ -109,6 +237,15 @@ def sync(
         dry_run=dry_run,
         push_only=push_only,
         use_hashtable=use_hashtable,
+        use_agent=use_agent,
+        compress=compress,
+        compress_threshold=compress_threshold,
+        delta=delta,
+        transfer_profile=transfer_profile,
+        checksum=checksum,
+        bundle=bundle,
+        profile=profile,
+        profile_json=profile_json,
     )
 
 
@@ -141,6 +278,10 @@ def sync(
     default=None,
     help="Path to mpy-cross executable in order to compile source files",
 )
+@_agent_option
+@_transfer_options
+@_sync_options
+@_profile_options
 def dev(
     port: str,
     dir_path: str,
@@ -148,6 +289,15 @@ def dev(
     no_prompt: bool,
     use_hashtable: bool,
     mpy_cross_path: Optional[str],
+    use_agent: bool,
+    compress: bool,
+    compress_threshold: int,
+    delta: bool,
+    transfer_profile: Optional[TransferProfile],
+    checksum: str,
+    bundle: bool,
+    profile: bool,
+    profile_json: Optional[str],
 ):
     """Start development mode on [PORT] in specified directory [DIR_PATH]
 
@@ -196,12 +346,23 @@ def dev(
         no_prompt=no_prompt,
         use_hashtable=use_hashtable,
         mpy_cross_path=mpy_cross_path,
+        use_agent=use_agent,
+        compress=compress,
+        compress_threshold=compress_threshold,
+        delta=delta,
+        transfer_profile=transfer_profile,
+        checksum=checksum,
+        bundle=bundle,
+        profile=profile,
+        profile_json=profile_json,
     )
 
 
 @main.command("clear", short_help="Delete all files from MicroPython device")
 @click.argument("port")
-def clear(port: str):
+@_agent_option
+@_profile_options
+def clear(port: str, use_agent: bool, profile: bool, profile_json: Optional[str]):
     """Delete all files from MicroPython device connected to [PORT]
 
     [PORT] can be full path or :
@@ -212,7 +373,12 @@ def clear(port: str):
 
             c[n]  connect to serial port "COM[n]"
     """
-    bridge.clear(port=port)
+    bridge.clear(
+        port=port,
+        use_agent=use_agent,
+        profile=profile,
+        profile_json=profile_json,
+    )
 
 
 @main.command("list", short_help="List available devices")
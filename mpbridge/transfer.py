@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import signal
+import threading
+from contextlib import contextmanager
+from typing import NamedTuple
+
+from mpremote.transport_serial import TransportError
+
+ACK = b"\x06"
+# Sent before every chunk of a stream. Any other byte makes the receiver stop
+# and fail, so the host can end a transfer early without cutting a chunk short
+CHUNK_MARKER = b"\x06"
+ABORT_MARKER = b"\x18"
+
+MIN_CHUNK_SIZE = 256
+MAX_CHUNK_SIZE = 4096
+MAX_WINDOW = 8
+# Links faster than this are native USB CDC, which is flow-controlled, so
+# several chunks can safely be queued in the board's receive buffer
+FAST_LINK_THRESHOLD = 100_000
+
+
+class TransferProfile(NamedTuple):
+    chunk_size: int
+    # Number of chunks sent before waiting for the oldest acknowledgement
+    window: int = 1
+    # Stream raw bytes to a receiver loop instead of one exec per chunk
+    streaming: bool = True
+
+    @classmethod
+    def parse(cls, value: str) -> TransferProfile | None:
+        # Accepts a profile name or CHUNK_SIZE[:WINDOW], None stands for auto
+        if value == "auto":
+            return None
+        if value in TRANSFER_PROFILES:
+            return TRANSFER_PROFILES[value]
+        chunk_size, _, window = value.partition(":")
+        profile = cls(chunk_size=int(chunk_size), window=int(window or 1))
+        if profile.chunk_size < 1 or profile.window < 1:
+            raise ValueError("chunk size and window must be positive")
+        return profile
+
+    def describe(self) -> str:
+        if not self.streaming:
+            return f"{self.chunk_size} byte chunks, one exec per chunk"
+        return f"{self.chunk_size} byte chunks, {self.window} in flight"
+
+
+TRANSFER_PROFILES = {
+    # Original behaviour, for firmware without sys.stdin.buffer
+    "legacy": TransferProfile(chunk_size=256, window=1, streaming=False),
+    # USB-UART bridges with small receive buffers (ESP8266, ESP32)
+    "uart": TransferProfile(chunk_size=1024, window=1),
+    "esp8266": TransferProfile(chunk_size=512, window=1),
+    "esp32": TransferProfile(chunk_size=1024, window=1),
+    # Native USB CDC (RP2040, pyboard, ESP32-S2/S3)
+    "usb": TransferProfile(chunk_size=2048, window=4),
+    "rp2": TransferProfile(chunk_size=4096, window=8),
+}
+
+
+def auto_profile(mem_free: int, round_trip: float, bytes_per_sec: float):
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size * 2 <= min(mem_free // 16, MAX_CHUNK_SIZE):
+        chunk_size *= 2
+    window = 1
+    if bytes_per_sec >= FAST_LINK_THRESHOLD:
+        # Keep enough data in flight to cover an acknowledgement round-trip
+        window = int(round_trip * bytes_per_sec // chunk_size) + 2
+    return TransferProfile(chunk_size=chunk_size, window=max(1, min(window, MAX_WINDOW)))
+
+
+def read_exact(serial, size: int) -> bytes:
+    data = serial.read(size)
+    while len(data) < size:
+        data += serial.read(size - len(data))
+    return data
+
+
+class TransferInterrupted(Exception):
+    # Raised by send_windowed once every chunk sent has been acknowledged and
+    # the receiver has been told to stop, or has received everything. The
+    # caller reads the receiver's response before raising `reason` again
+    def __init__(self, reason: BaseException):
+        super().__init__(reason)
+        self.reason = reason
+
+
+@contextmanager
+def deferred_interrupt():
+    # Ctrl-C only sets the flag, so a stream is never cut inside a chunk. A
+    # second Ctrl-C interrupts right away
+    pending = []
+    previous = signal.getsignal(signal.SIGINT)
+    if previous is None or threading.current_thread() is not threading.main_thread():
+        yield pending
+        return
+
+    def handler(signum, frame):
+        pending.append(signum)
+        signal.signal(signal.SIGINT, previous)
+
+    signal.signal(signal.SIGINT, handler)
+    try:
+        yield pending
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+
+def send_windowed(
+    serial, file, size: int, chunk_size: int, window: int, progress_callback=None
+):
+    written = 0
+    acked = 0
+    in_flight = 0
+    reason = None
+    with deferred_interrupt() as interrupted:
+        while acked < size:
+            while written < size and in_flight < window and reason is None:
+                try:
+                    if interrupted:
+                        raise KeyboardInterrupt
+                    chunk = file.read(min(chunk_size, size - written))
+                    if not chunk:
+                        raise TransportError("source file changed while writing")
+                except (Exception, KeyboardInterrupt) as e:
+                    # The acknowledgements of the chunks in flight still
+                    # arrive before the receiver fails
+                    serial.write(ABORT_MARKER)
+                    reason = e
+                    break
+                serial.write(CHUNK_MARKER + chunk)
+                written += len(chunk)
+                in_flight += 1
+            if reason is not None and not in_flight:
+                raise TransferInterrupted(reason)
+            response = serial.read(1)
+            if response != ACK:
+                raise TransportError("unexpected response while writing", response)
+            in_flight -= 1
+            acked = min(acked + chunk_size, size)
+            if progress_callback:
+                progress_callback(acked, size)
+        if interrupted:
+            raise TransferInterrupted(KeyboardInterrupt())
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from . import utils
+from .hashcache import HashCache
+from .hashtable import HashTable
+from .ignore import IGNORE_FILE_NAME, IgnoreStorage
+from .pipeline import WORKERS
+
+
+# Snapshot of a local directory taken with a single scandir pass. Ignore files
+# are loaded while walking, so ignored directories are never entered and
+# ignored files are left out of the snapshot
+class LocalTree:
+    def __init__(self, dir_path: str):
+        self.root = utils.replace_backslashes(dir_path).rstrip("/")
+        self.ignore = IgnoreStorage(dir_path=self.root, load=False)
+        self.dirs: dict[str, str] = {}
+        self.files: dict[str, str] = {}
+        self.stats: dict[str, os.stat_result] = {}
+        self._digests: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._walk()
+
+    def start_hashing(self, algorithm: str = "sha1"):
+        # Hashed once per snapshot and checksum in the background, so boards
+        # synced from it share the work and the caller can talk to the board
+        # in the meantime
+        with self._lock:
+            if algorithm not in self._digests:
+                executor = ThreadPoolExecutor(max_workers=1)
+                self._digests[algorithm] = executor.submit(self._hash, algorithm)
+                executor.shutdown(wait=False)
+
+    def get_digests(self, algorithm: str = "sha1") -> dict[str, bytes]:
+        self.start_hashing(algorithm)
+        return self._digests[algorithm].result()
+
+    def _hash(self, algorithm: str) -> dict[str, bytes]:
+        hashes = HashCache.for_dir(self.root, algorithm)
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            digests = pool.map(
+                lambda item: hashes.get_digest(self.files[item[0]], item[1]),
+                self.stats.items(),
+            )
+            digests = dict(zip(self.stats, digests))
+        hashes.save()
+        return digests
+
+    def _walk(self):
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            abs_dir = self.root + rel_dir
+            with os.scandir(abs_dir or "/") as iterator:
+                entries = sorted(iterator, key=lambda e: e.name)
+            if any(e.name == IGNORE_FILE_NAME and e.is_file() for e in entries):
+                self.ignore.load_ignore_file(abs_dir)
+            subdirs = []
+            for entry in entries:
+                rel_path = f"{rel_dir}/{entry.name}"
+                if entry.is_dir():
+                    if not self.ignore.match_dir(rel_path):
+                        self.dirs[rel_path] = f"{abs_dir}/{entry.name}"
+                        subdirs.append(rel_path)
+                elif not self.ignore.match_file(rel_path):
+                    self.files[rel_path] = f"{abs_dir}/{entry.name}"
+                    self.stats[rel_path] = entry.stat()
+            # Reversed so that directories are visited in name order
+            stack.extend(reversed(subdirs))
+
+
+# Model of the board's filesystem, listed once per raw REPL session and then
+# kept up to date by the mutations mpbridge performs itself
+class RemoteTree:
+    def __init__(
+        self,
+        dirs: Optional[dict[str, int]] = None,
+        files: Optional[dict[str, int]] = None,
+        mtimes: Optional[dict[str, int]] = None,
+    ):
+        self.dirs = dict(dirs or {})
+        self.files = dict(files or {})
+        # Board clock, only known for entries that were listed
+        self.mtimes = dict(mtimes or {})
+        # Digests of file contents with the session's checksum, as hashed or
+        # written in this session
+        self.digests: dict[str, bytes] = {}
+        # Parsed mpbridge.hashtable, read on first use
+        self.hashtable: Optional[HashTable] = None
+
+    def add_entry(self, is_file: bool, size: int, mtime: int, path: str):
+        if is_file:
+            self.files[path] = size
+        else:
+            self.dirs[path] = 0
+        self.mtimes[path] = mtime
+
+    def add_dir(self, path: str):
+        path = _remote_path(path)
+        self.dirs[path] = 0
+        self.mtimes.pop(path, None)
+
+    def add_file(self, path: str, size: int):
+        path = _remote_path(path)
+        self.files[path] = size
+        self.mtimes.pop(path, None)
+        self.digests.pop(path, None)
+
+    def append_file(self, path: str, size: int):
+        path = _remote_path(path)
+        self.add_file(path, self.files.get(path, 0) + size)
+
+    def copy_file(self, src: str, dest: str):
+        src, dest = _remote_path(src), _remote_path(dest)
+        self.add_file(dest, self.files[src])
+        if src in self.digests:
+            self.digests[dest] = self.digests[src]
+
+    def remove_dir(self, path: str):
+        path = _remote_path(path)
+        self.dirs.pop(path, None)
+        self.mtimes.pop(path, None)
+
+    def remove_file(self, path: str):
+        path = _remote_path(path)
+        self.files.pop(path, None)
+        self.mtimes.pop(path, None)
+        self.digests.pop(path, None)
+
+    def rename(self, src: str, dest: str):
+        src, dest = _remote_path(src), _remote_path(dest)
+        for entries in (self.dirs, self.files, self.mtimes, self.digests):
+            for path in [p for p in entries if p == src or p.startswith(src + "/")]:
+                entries[dest + path[len(src) :]] = entries.pop(path)
+
+
+def _remote_path(path: str) -> str:
+    return "/" + path.lstrip("/")
@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from colorama import Fore
+
+from . import utils
+from .serial_transport import ExtendedSerialTransport
+
+# Quiet period a path must reach before its pending operation is performed
+DEBOUNCE_SECONDS = 0.3
+# Directory moves remembered to recognise the moves reported for their contents
+MOVE_HISTORY = 32
+
+
+class PendingOp(NamedTuple):
+    op: str
+    path: str
+    # Source path of a rename
+    src: Optional[str] = None
+    # Created during the debounce window, so the board has never seen it
+    created: bool = False
+    touched: float = 0.0
+
+
+def _related(a: str, b: str) -> bool:
+    return a == b or a.startswith(b + "/") or b.startswith(a + "/")
+
+
+class UploadQueue:
+    # Filesystem events are merged per path into one net operation and a
+    # single worker thread performs them once the path has been quiet for
+    # `debounce` seconds. Operations run in the order they were first queued,
+    # and an operation that is not due yet holds back later ones on related
+    # paths, so a directory is always created before its files are uploaded
+    def __init__(
+        self,
+        st: ExtendedSerialTransport,
+        base_path: str,
+        debounce: float = DEBOUNCE_SECONDS,
+    ):
+        self.st = st
+        self.base_path = base_path
+        self.debounce = debounce
+        self._pending: dict[int, PendingOp] = {}
+        self._latest: dict[str, int] = {}
+        self._seq = 0
+        # (src, dest, renamed on the board) of recent directory moves
+        self._dir_moves: list[tuple[str, str, bool]] = []
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        # Pending operations are flushed before the worker exits
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def put(self, path: str, created: bool = False):
+        with self._cond:
+            self._ready_parents(path)
+            existing = self._latest_op(path)
+            if existing is not None and (
+                existing.op == "put" or (existing.op == "rm" and self._is_last(path))
+            ):
+                self._pop_latest(path)
+                # Still on the board unless it was created in the meantime
+                created = existing.created
+            else:
+                self._ready(path)
+            self._add(PendingOp("put", path, created=created))
+
+    def mkdir(self, path: str):
+        with self._cond:
+            self._forget_dir_moves(path)
+            self._ready_parents(path)
+            existing = self._latest_op(path)
+            if existing is not None and existing.op == "rmdir" and self._is_last(path):
+                # Removed and created again, nothing changed on the board
+                self._pop_latest(path)
+                return
+            self._ready(path)
+            self._add(PendingOp("mkdir", path, created=True))
+
+    def delete(self, path: str, is_dir: bool):
+        op = "rmdir" if is_dir else "rm"
+        with self._cond:
+            self._ready_parents(path)
+            existing = self._latest_op(path)
+            if existing is not None and existing.op in ("put", "mkdir"):
+                self._pop_latest(path)
+                if existing.created:
+                    return
+            elif existing is not None:
+                # A rename may have replaced a file at `path`, so it is still
+                # performed before `path` is removed
+                self._ready(path)
+            self._add(PendingOp(op, path))
+
+    def move(self, src: str, dest: str, is_dir: bool = False):
+        with self._cond:
+            for moved_src, moved_dest, renamed in reversed(self._dir_moves):
+                if (
+                    src.startswith(moved_src + "/")
+                    and dest == moved_dest + src[len(moved_src) :]
+                ):
+                    # Reported for the contents of a moved directory
+                    if not renamed and dest not in self._latest:
+                        self._add(
+                            PendingOp("mkdir" if is_dir else "put", dest, created=True)
+                        )
+                    return
+            self._forget_dir_moves(dest)
+            self._ready_parents(src)
+            self._ready_parents(dest)
+            existing = self._latest_op(dest)
+            if existing is not None and existing.op == "put":
+                # A pending upload of `dest` is superseded by the moved file
+                self._pop_latest(dest)
+            else:
+                self._ready(dest)
+            source = self._latest_op(src)
+            subtree = [path for path in self._latest if path.startswith(src + "/")]
+            created = source is not None and source.created
+            if created and all(self._latest_op(path).created for path in subtree):
+                # Never reached the board, so it is simply created under the
+                # new name, after anything its new parents depend on
+                self._pop_latest(src)
+                # A file may have been replaced at `dest`
+                self._add(source._replace(path=dest, created=source.op == "mkdir"))
+                for path in subtree:
+                    op = self._pop_latest(path)
+                    self._add(op._replace(path=dest + path[len(src) :]))
+                if is_dir:
+                    self._remember_dir_move(src, dest, False)
+                return
+            if source is not None and source.op == "put":
+                # The old content is not on the board under either name
+                self._pop_latest(src)
+                self._add(PendingOp("rm", src))
+                self._add(PendingOp("put", dest))
+                return
+            self._ready(src)
+            if is_dir:
+                self._remember_dir_move(src, dest, True)
+            # Pending operations on the contents run before the rename,
+            # except uploads, which read the file from its new path
+            puts = []
+            for path in subtree:
+                op = self._latest_op(path)
+                if op is not None and op.op == "put":
+                    puts.append(self._pop_latest(path))
+                else:
+                    self._ready(path)
+            self._add(PendingOp("rename", dest, src=src))
+            for op in puts:
+                self._add(op._replace(path=dest + op.path[len(src) :]))
+
+    def _remember_dir_move(self, src: str, dest: str, renamed: bool):
+        self._dir_moves = self._dir_moves[-MOVE_HISTORY + 1 :]
+        self._dir_moves.append((src, dest, renamed))
+
+    def _forget_dir_moves(self, path: str):
+        # Moves out of a directory created again at `path` are real moves
+        self._dir_moves = [
+            move
+            for move in self._dir_moves
+            if move[0] != path and not move[0].startswith(path + "/")
+        ]
+
+    def _latest_op(self, path: str) -> Optional[PendingOp]:
+        seq = self._latest.get(path)
+        return None if seq is None else self._pending[seq]
+
+    def _pop_latest(self, path: str) -> Optional[PendingOp]:
+        seq = self._latest.pop(path, None)
+        return None if seq is None else self._pending.pop(seq)
+
+    def _ready(self, path: str):
+        # The pending operation of `path` is performed without waiting any
+        # longer, at its place in the queue, and so are those of its parents
+        while path:
+            seq = self._latest.pop(path, None)
+            if seq is not None:
+                self._pending[seq] = self._pending[seq]._replace(touched=0.0)
+                self._cond.notify()
+            path = path.rpartition("/")[0]
+
+    def _is_last(self, path: str) -> bool:
+        # Whether nothing queued after the pending operation of `path` depends
+        # on it
+        seq = self._latest[path]
+        return not any(
+            _related(path, other)
+            for later, op in self._pending.items()
+            if later > seq
+            for other in (op.path, op.src or op.path)
+        )
+
+    def _ready_parents(self, path: str):
+        # Operations inside a directory whose rename is pending refer to the
+        # new path, which only exists once the rename has been performed
+        parent = path.rpartition("/")[0]
+        while parent:
+            op = self._latest_op(parent)
+            if op is not None and op.op == "rename":
+                self._ready(parent)
+            parent = parent.rpartition("/")[0]
+
+    def _add(self, op: PendingOp):
+        self._seq += 1
+        self._pending[self._seq] = op._replace(touched=time.monotonic())
+        self._latest[op.path] = self._seq
+        self._cond.notify()
+
+    def _take_due(self) -> tuple[list[PendingOp], float]:
+        now = time.monotonic()
+        due = []
+        blocked = []
+        delay = self.debounce
+        for seq, op in list(self._pending.items()):
+            paths = [op.path] if op.src is None else [op.path, op.src]
+            wait = op.touched + self.debounce - now
+            if (wait > 0 and not self._stopped) or any(
+                _related(path, other) for path in paths for other in blocked
+            ):
+                blocked.extend(paths)
+                delay = min(delay, max(wait, 0.01))
+                continue
+            del self._pending[seq]
+            if self._latest.get(op.path) == seq:
+                del self._latest[op.path]
+            due.append(op)
+        return due, delay
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._pending:
+                    self._cond.wait()
+                if self._stopped and not self._pending:
+                    return
+                due, delay = self._take_due()
+                if not due:
+                    self._cond.wait(delay)
+                    continue
+            self._perform(due)
+
+    def _perform(self, ops: list[PendingOp]):
+        # Consecutive mkdir/rm/rmdir/rename operations share one round-trip
+        batch = []
+        for op in ops + [None]:
+            if op is not None and op.op == "rename":
+                batch.append((op.op, op.src, op.path))
+                continue
+            if op is not None and op.op != "put":
+                batch.append((self._delete_op(op), op.path, None))
+                continue
+            if batch:
+                self._run_safely(self.st.fs_verbose_batch, batch)
+                batch = []
+            if op is not None:
+                self._run_safely(
+                    self.st.fs_verbose_put, self.base_path + op.path, op.path
+                )
+
+    def _delete_op(self, op: PendingOp) -> str:
+        # Some platforms report deleted directories as file events
+        tree = self.st.remote_tree
+        if op.op == "rm" and tree is not None and op.path in tree.dirs:
+            return "rmdir"
+        return op.op
+
+    @staticmethod
+    def _run_safely(func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            # An unexpected failure must not stop the worker thread
+            print(Fore.RED, "E", str(e) or type(e).__name__)
+            utils.reset_term_color()
@@ -1,14 +1,16 @@
 from __future__ import annotations
 
-import hashlib
 import os
 import re
 import struct
 import subprocess
 import sys
+import zlib
 
 from colorama import Style
 
+from .checksum import new_hasher
+
 
 def remove_prefix(string: str, prefix: str) -> str:
     if string.startswith(prefix):
@@ -86,17 +88,53 @@ def recursive_list_dir(path: str) -> tuple[dict[str, str], dict[str, str]]:
     return out_dirs, out_files
 
 
-def get_file_sha1(path: str) -> bytes:
+def get_file_digest(
+    path: str, algorithm: str = "sha1", block_size: int = 65536
+) -> bytes:
+    hasher = new_hasher(algorithm)
     with open(path, "rb") as file:
-        return hashlib.sha1(file.read()).digest()
+        while block := file.read(block_size):
+            hasher.update(block)
+    return hasher.digest()
+
+
+def get_cache_dir() -> str:
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/AppData/Local")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "mpbridge")
+
+
+def get_mirror_dir(key: str) -> str:
+    return os.path.join(get_cache_dir(), "mirrors", re.sub(r"[^\w.-]", "_", key))
+
+
+def batched_by_size(items: list, max_size: int, size_of=len):
+    batch = []
+    size = 0
+    for item in items:
+        item_size = size_of(item)
+        if batch and size + item_size > max_size:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(item)
+        size += item_size
+    if batch:
+        yield batch
+
+
+def compress(data: bytes) -> bytes:
+    # A 1 KB window keeps the decompressor small enough for MicroPython boards
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 10)
+    return compressor.compress(data) + compressor.flush()
 
 
-def get_temp_dirname_prefix(full_port: str):
-    return (
-        "mpbridge-"
-        + remove_prefix(full_port, "/dev/").replace("tty", "").replace("/", "-")
-        + "-"
-    )
+def decompress(data: bytes) -> bytes:
+    return zlib.decompress(data)
 
 
 def unpack_length_prefixed(size_header_fmt: str, data: bytes | bytearray | memoryview):